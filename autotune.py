@@ -0,0 +1,245 @@
+#!/usr/bin/env python 
+
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+Tunes the classification ranks per server, Ilastik threads per rank and share of the server memory. A few
+representative sub-volumes are classified on this server under each configuration of the sweep and the
+configuration with the most voxels classified per second on the server is written to autotune_file.
+
+Run it on one server of the kind that will run segment_subvols_pixels.py, after make_subvolume_mpi.py:
+    python autotune.py
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from segmentation_param import *
+from tile_grid import TileGrid
+from tile_planner import bytes_per_voxel, tile_memory_mb
+
+__author__ = "Mehdi Tondravi"
+__copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['tune_configs',
+           'run_config',
+           'autotune']
+
+# Seconds a rank of a configuration waits for the other ranks to be ready, e.g. to load the classifier.
+_ready_timeout = 3600
+
+
+def _server_cpus():
+    """
+    Returns the CPUs this process may run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def _config_values(value, default):
+    """
+    Returns the values of a sweep option, a number or a tuple of numbers, or default if it is blank.
+    """
+    if value == '' or value is None:
+        return list(default)
+    if isinstance(value, (tuple, list)):
+        return [int(item) for item in value]
+    return [int(value)]
+
+
+def tune_configs(cpu_count):
+    """
+    Returns the (ranks per server, threads per rank, percent of memory) configurations of the sweep. By
+    default the ranks are the powers of two up to the CPUs (and the CPUs), the threads of a rank are the CPUs
+    divided among the ranks and the memory is percent_mem_to_use, see autotune_ranks, autotune_threads and
+    autotune_mem_percents.
+    """
+    default_ranks = sorted(set([2 ** power for power in range(int(np.log2(cpu_count)) + 1)] + [cpu_count]))
+    default_percent = int(percent_mem_to_use) if percent_mem_to_use else 100
+    configs = []
+    for ranks in _config_values(autotune_ranks, default_ranks):
+        for threads in _config_values(autotune_threads, [max(cpu_count // ranks, 1)]):
+            for percent in _config_values(autotune_mem_percents, [default_percent]):
+                configs.append((ranks, threads, percent))
+    return configs
+
+
+def _rank_cpus(rank, threads, cpus):
+    """
+    Returns the CPUs a rank is pinned to, threads CPUs after the ones of the previous ranks.
+    """
+    return [cpus[(rank * threads + cpu) % len(cpus)] for cpu in range(threads)]
+
+
+def _tune_rank(rank, tiles, threads, ram, cpus, ready, results):
+    """
+    Classifies the tiles in a rank of a configuration and puts (rank, voxels, start, stop, error) on the
+    results queue. The classifier is loaded on an x-block of twice the overlap plus one slices of the first
+    tile, so that its features are well defined, and the timing starts when all ranks are ready.
+    """
+    try:
+        from classify_pixel import classify_pixel
+        from volume_backend import process_volume, read_volume_box
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        grid = TileGrid.load(tile_grid_file)
+        vol_dataset = process_volume()
+        subvol_images = [read_volume_box(vol_dataset, *grid.halo_box(tile)) for tile in tiles]
+        classify_pixel(subvol_images[0][:2 * grid.overlap + 1], classifier, threads, ram)
+        ready.wait(_ready_timeout)
+        start = time.time()
+        for subvol_data in subvol_images:
+            classify_pixel(subvol_data, classifier, threads, ram)
+        results.put((rank, sum(subvol_data.size for subvol_data in subvol_images), start, time.time(), None))
+    except Exception as error:
+        ready.abort()
+        results.put((rank, 0, 0.0, 0.0, repr(error)))
+
+
+def run_config(ranks, threads, percent, tiles, pin_cpus=False):
+    """
+    Classifies the tiles with each of ranks processes, threads Ilastik threads and an equal share of
+    percent of the server memory each, like ranks classification ranks on a server. Returns the voxels
+    classified per second on the server, from the first rank starting to the last rank finishing, or None
+    if a rank failed.
+    """
+    cpus = _server_cpus()
+    ram = int(ram_size * percent / 100.0 / ranks)
+    context = multiprocessing.get_context('spawn')
+    ready = context.Barrier(ranks)
+    results = context.Queue()
+    processes = [context.Process(target=_tune_rank,
+                                 args=(rank, tiles, threads, ram,
+                                       _rank_cpus(rank, threads, cpus) if pin_cpus else None, ready, results))
+                 for rank in range(ranks)]
+    for process in processes:
+        process.start()
+    rank_results = []
+    while len(rank_results) < ranks:
+        try:
+            rank_results.append(results.get(timeout=1))
+        except queue.Empty:
+            # A rank killed, e.g. out of memory, puts no result.
+            if any(process.exitcode not in (None, 0) for process in processes):
+                for process in processes:
+                    process.terminate()
+                for process in processes:
+                    process.join()
+                results.close()
+                print("*** Configuration failed: a rank exited ***")
+                return None
+    for process in processes:
+        process.join()
+    results.close()
+    errors = [error for _, _, _, _, error in rank_results if error is not None]
+    if errors:
+        print("*** Configuration failed: %s ***" % errors[0])
+        return None
+    voxels = sum(rank_voxels for _, rank_voxels, _, _, _ in rank_results)
+    seconds = max(stop for _, _, _, stop, _ in rank_results) - min(start for _, _, start, _, _ in rank_results)
+    return voxels / max(seconds, 1e-6)
+
+
+def autotune():
+    """
+    Runs the configurations of tune_configs() on autotune_tiles sub-volumes spread over the volume and writes
+    the fastest, with the results of all configurations, to autotune_file. A configuration whose sub-volume
+    does not fit into the memory share of a rank (see tile_planner.py) is skipped.
+    """
+    if not os.path.exists(tile_grid_file):
+        print("*** Did not find the sub-volume grid file %s ***" % tile_grid_file)
+        return None
+    grid = TileGrid.load(tile_grid_file)
+    tiles = grid.sample_tiles(int(autotune_tiles))
+    if len(tiles) == 0:
+        print("*** No foreground sub-volume to tune on ***")
+        return None
+    pin_cpus = autotune_pin_cpus.upper() == 'YES' and hasattr(os, 'sched_setaffinity')
+    cpu_count = len(_server_cpus())
+    mem_required = max(tile_memory_mb(grid.halo_shape(tile), bytes_per_voxel()) for tile in tiles)
+    print("Tuning on sub-volumes %s, %d CPUs, %d MB of memory, pinned CPUs is %s" %
+          (tiles.tolist(), cpu_count, ram_size, pin_cpus))
+    results = []
+    for ranks, threads, percent in tune_configs(cpu_count):
+        ram = int(ram_size * percent / 100.0 / ranks)
+        if mem_required > ram:
+            print("ranks %d, threads %d, memory %d%%: skipped, a rank needs %d MB and has %d MB" %
+                  (ranks, threads, percent, mem_required, ram))
+            continue
+        voxels_per_sec = run_config(ranks, threads, percent, tiles, pin_cpus)
+        if voxels_per_sec is None:
+            continue
+        print("ranks %d, threads %d, memory %d%%: %d voxels/sec" % (ranks, threads, percent, voxels_per_sec))
+        results.append({'ranks_per_node': ranks, 'no_of_threads_to_use': threads, 'percent_mem_to_use': percent,
+                        'voxels_per_sec': voxels_per_sec})
+    if not results:
+        print("*** No configuration could classify the sub-volumes ***")
+        return None
+    best = dict(max(results, key=lambda result: result['voxels_per_sec']))
+    best.update({'autotune_pin_cpus': 'yes' if pin_cpus else 'no', 'tiles': tiles.tolist(), 'results': results})
+    with open(autotune_file, 'w') as tune_file:
+        json.dump(best, tune_file, indent=2)
+    print("Best configuration is %d ranks per server with %d threads and %d%% of the memory, %d voxels/sec" %
+          (best['ranks_per_node'], best['no_of_threads_to_use'], best['percent_mem_to_use'], best['voxels_per_sec']))
+    print("Set ranks_per_node = '%d', no_of_threads_to_use = '%d' and percent_mem_to_use = '%d' in "
+          "seg_user_param.py, written to %s" % (best['ranks_per_node'], best['no_of_threads_to_use'],
+                                                best['percent_mem_to_use'], autotune_file))
+    return best
+
+
+if __name__ == '__main__':
+    autotune()
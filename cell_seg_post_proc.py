@@ -9,22 +9,29 @@ import numpy as np
 import h5py
 from scipy import ndimage as ndi
 from skimage import morphology
-from glob import glob
-from mpi4py import MPI
+from executor import MPI, get_executor
 import time
 from segmentation_param import *
+from tile_grid import TileGrid
 import pdb
 
 # cell segmentation post processing
 def cell_seg_post_proc():
-    comm = MPI.COMM_WORLD
+    executor = get_executor()
+    comm = executor.comm
     rank = comm.Get_rank()
-    size = MPI.COMM_WORLD.Get_size()
+    size = comm.Get_size()
     name = MPI.Get_processor_name()
     start_time = int(time.time())
-    # Get the list of all segmented sub-volume files.
-    input_files = sorted(glob(outimage_file_location + '/*subvol*.h5'))
-    if not input_files:
+    # The sub-volumes are the tiles of the grid written by make_subvolume_mpi.py.
+    if not os.path.exists(tile_grid_file):
+        print("*** Did not find the sub-volume grid file %s ***" % tile_grid_file)
+        return
+    grid = TileGrid.load(tile_grid_file)
+    # Background sub-volumes have no files, their part of the volume is left unallocated and reads as zero.
+    tiles = grid.foreground_tiles()
+    input_files = [outimage_file_location + '/subvol_' + subvol_name(tile) + '.h5' for tile in tiles]
+    if not input_files or not os.path.exists(input_files[0]):
         print("*** Did not find any sub-volume segmented file in location %s ***" % outimage_file_location)
         return
     
@@ -33,15 +40,7 @@ def cell_seg_post_proc():
     if cell_label_defined == False:
         print("Cell class is not labeled in the Ilastik training data file, no processing will take place")
         return
-    # Shape/Dimension of the volume image is available in the last sub-volume file.
-    volume_ds_shape = np.zeros((3,), dtype='uint64')
-    # Last file has the dimensions for the volume.
-    f = h5py.File(input_files[-1], 'r')
-    volshape = f['orig_indices']
-    volume_ds_shape[0] = volshape[1]
-    volume_ds_shape[1] = volshape[3]
-    volume_ds_shape[2] = volshape[5]
-    f.close()
+    volume_ds_shape = np.array(grid.vol_shape, dtype='uint64')
     # Get the list of segmented datasets
     # seg_ds_list = f.keys()
     labeld_obj = get_ilastik_labels()
@@ -70,42 +69,30 @@ def cell_seg_post_proc():
     if rank == 0:
         print("Dataset name to apply post processing is %s" % ds_name)
     vol_seg_dataset = vol_img_file.create_dataset(ds_name, volume_ds_shape, dtype='uint32',
-                                                  chunks=(1, il_sub_vol_y, il_sub_vol_z))
-    iterations = int(len(input_files) / size) + (len(input_files) % size > 0)
-    for idx in range(iterations):
-        if (rank + (size * idx)) >= len(input_files):
-            print("\nBREAKING out, my rank is %d, number of files is %d, size is %d and idx is %d" % 
-                  (rank, len(input_files), size, idx))
-            break
-        print("*** Working on file %s and rank is %d ***" % (input_files[rank + size * idx], rank))
-        subvol_file = h5py.File(input_files[rank + size * idx], 'r')
-        # Retrieve indices into the whole volume.
-        orig_idx_ds = subvol_file['orig_indices']
-        orig_idx = orig_idx_ds[...]
-        
-        # Retrieve overlap size to the right and left side of the sub-volume.
-        right_overlapds = subvol_file['right_overlap']
-        rightoverlap = right_overlapds[...]
-        left_overlapds = subvol_file['left_overlap']
-        leftoverlap = left_overlapds[...]
-        
-        myds = subvol_file[ds_name]
-        subvoldata = myds[...]
-        x_dim = subvoldata.shape[0]
-        y_dim = subvoldata.shape[1]
-        z_dim = subvoldata.shape[2]
-        subvoldata = subvoldata > 0
-        subvoldata = ndi.binary_fill_holes(subvoldata)
-        subvoldata = morphology.remove_small_objects(subvoldata, MINSZ_CELL, connectivity=2)
-        subvoldata = morphology.label(subvoldata.astype('uint32'))
-        
-        vol_seg_dataset[orig_idx[0]:orig_idx[1], orig_idx[2]:orig_idx[3], orig_idx[4]:orig_idx[5]] = \
-            subvoldata[leftoverlap[0] : x_dim - rightoverlap[0],
-                       leftoverlap[1] : y_dim - rightoverlap[1],
-                       leftoverlap[2] : z_dim - rightoverlap[2]]
-        subvol_file.close()
+                                                  chunks=(1,) + grid.tile_shape[1:])
+    # Sub-volume files of this rank, see tile_traversal and tile_assignment.
+    tile_files = dict(zip(tiles, input_files))
+    # The sub-volumes are processed by the executor's workers, this process writes them, see executor.py.
+    for tile, subvoldata in executor.imap(_post_proc_subvol, grid.rank_tiles(tiles, rank, size), tile_files, ds_name, grid):
+        vol_seg_dataset[grid.core_box(tile)] = subvoldata
+    executor.close()
     vol_img_file.close()
     print("Time to execute cell_seg_post_proc() is %d seconds and rank is %d" % ((time.time() - start_time), rank))
 
+def _post_proc_subvol(tile, tile_files, ds_name, grid):
+    """
+    Returns the tile and the core, without the overlaps, of its post processed dataset ds_name.
+    """
+    print("*** Working on file %s ***" % tile_files[tile])
+    subvol_file = h5py.File(tile_files[tile], 'r')
+    myds = subvol_file[ds_name]
+    subvoldata = myds[...]
+    subvol_file.close()
+    subvoldata = subvoldata > 0
+    subvoldata = ndi.binary_fill_holes(subvoldata)
+    subvoldata = morphology.remove_small_objects(subvoldata, MINSZ_CELL, connectivity=2)
+    subvoldata = morphology.label(subvoldata.astype('uint32'))
+    return tile, subvoldata[grid.core_in_halo(tile)]
+
 if __name__ == '__main__':
     cell_seg_post_proc()
@@ -51,24 +51,17 @@ Interface module to Ilastik pixel classifier to create probability maps for a gi
 '''
 
 from __future__ import (absolute_import, division, print_function, unicode_literals)
-import numpy as np
-import six
-import pdb
-from collections import OrderedDict
-import vigra
-import os
-import ilastik_main
-from ilastik.applets.dataSelection import DatasetInfo
-from ilastik.workflows.pixelClassification import PixelClassificationWorkflow
+from segmentation_param import *
 
 def classify_pixel(input_data, classifier, threads, ram):
 
     """
     Interface function to Ilastik object classifier functions.  
     
-    Runs a pre-trained ilastik classifier on a volume of data
-    Adapted from Stuart Berg's example here:
-    https://github.com/ilastik/ilastik/blob/master/examples/example_python_client.py
+    Runs a pre-trained ilastik classifier on a volume of data. The Ilastik project is loaded by the first
+    call of a process and kept loaded for the later calls, see ilastik_session.py. With pixel_classifier
+    'native' the exported classifier of the project is run instead and Ilastik is not imported, see
+    native_classifier.py.
 
     Arguments:
         input_data: data to be classified - 3D numpy array
@@ -80,54 +73,8 @@ def classify_pixel(input_data, classifier, threads, ram):
         pixel_out: The probability maps for the classified pixels
     """
     
-    # Before we start ilastik, prepare these environment variable settings.
-    os.environ["LAZYFLOW_THREADS"] = str(threads)
-    os.environ["LAZYFLOW_TOTAL_RAM_MB"] = str(ram)
-
-    # Set the command-line arguments directly into argparse.Namespace object
-    # Provide your project file, and don't forget to specify headless.
-    args = ilastik_main.parser.parse_args([])
-    args.headless = True
-    args.project = classifier
-
-    # Instantiate the 'shell', (an instance of ilastik.shell.HeadlessShell)
-    # This also loads the project file into shell.projectManager
-    shell = ilastik_main.main(args)
-    assert isinstance(shell.workflow, PixelClassificationWorkflow)
-
-    # Obtain the training operator
-    opPixelClassification = shell.workflow.pcApplet.topLevelOperator
-
-    # Sanity checks
-    assert len(opPixelClassification.InputImages) > 0
-    assert opPixelClassification.Classifier.ready()
-
-    # In this example, we're using 3D data (extra dimension for channel).
-    # Tagging the data ensures that ilastik interprets the axes correctly.
-    input_data = vigra.taggedView(input_data, 'zyx')
-
-    # In case you're curious about which label class is which,
-    # let's read the label names from the project file.
-    label_names = opPixelClassification.LabelNames.value
-    label_colors = opPixelClassification.LabelColors.value
-    probability_colors = opPixelClassification.PmapColors.value
-    
-    print("label_names, label_colors, probability_colors", label_names, label_colors, probability_colors)
-    
-    # Construct an OrderedDict of role-names -> DatasetInfos
-    # (See PixelClassificationWorkflow.ROLE_NAMES)
-    role_data_dict = OrderedDict([("Raw Data",
-                                   [DatasetInfo(preloaded_array=input_data)])])
-    
-    # Run the export via the BatchProcessingApplet
-    # Note: If you don't provide export_to_array, then the results will
-    #       be exported to disk according to project's DataExport settings.
-    #       In that case, run_export() returns None.
-    
-    predictions = shell.workflow.batchProcessingApplet.\
-        run_export(role_data_dict, export_to_array=True)
-    print("predictions.dtype, predictions.shape", predictions[0].dtype, predictions[0].shape)
-    
-    print("DONE.")
-    
-    return predictions[0]
+    if pixel_classifier.lower() == 'native':
+        from native_classifier import native_classifier
+        return native_classifier(classifier).classify(input_data, threads)
+    from ilastik_session import ilastik_session
+    return ilastik_session(classifier, threads, ram).classify(input_data)
@@ -56,10 +56,11 @@ import pdb
 import os.path
 import h5py
 import numpy as np
-from glob import glob
-from mpi4py import MPI
+from executor import MPI, get_executor
 import time
 from segmentation_param import *
+from prob_map_codec import create_prob_map_dataset, decode_prob_map, encode_prob_map, prob_map_encoding
+from tile_grid import TileGrid
 
 __author__ = "Mehdi Tondravi"
 __copyright__ = "Copyright (c) 2016, UChicago Argonne, LLC."
@@ -75,26 +76,26 @@ def combine_subvols_prob_map():
     Output: The whole volume image file - its location is specified in the seg_user_param.py file. 
     """
     start_time = time.time()
-    comm = MPI.COMM_WORLD
+    executor = get_executor()
+    comm = executor.comm
     rank = comm.Get_rank()
-    size = MPI.COMM_WORLD.Get_size()
+    size = comm.Get_size()
     server_name = MPI.Get_processor_name()
     if rank == 0:
         print("Entered the function and size is %d" % size)
-    # Get the list of all subarray probability map files . Assumes file extension is .h5
-    input_files = sorted(glob(hdf_subvol_files_location + '/*subarr*.h5'))
-    if not input_files:
-        print("*** Did not find any file ending with .h5 extension  ***", hdf_subvol_files_location)
+    # The sub-volumes are the tiles of the grid written by make_subvolume_mpi.py.
+    if not os.path.exists(tile_grid_file):
+        print("*** Did not find the sub-volume grid file %s ***" % tile_grid_file)
         return
-    # Shape/Dimension of the volume image is available in the last sub-volume file.
-    volume_ds_shape = np.zeros((3,), dtype='uint64')
-    
-    # Last file has the dimensions for the volume.
-    f = h5py.File(input_files[-1], 'r')
-    volshape = f['orig_indices']
-    volume_ds_shape[0] = volshape[1]
-    volume_ds_shape[1] = volshape[3]
-    volume_ds_shape[2] = volshape[5]
+    grid = TileGrid.load(tile_grid_file)
+    # Background sub-volumes have no files, their part of the volume is left unallocated and reads as zero.
+    tiles = grid.foreground_tiles()
+    input_files = [hdf_subvol_files_location + '/subarr_prob_map_' + str(tile).zfill(5) + '.h5' for tile in tiles]
+    if not input_files or not os.path.exists(input_files[0]):
+        print("*** Did not find any probability map file in %s location ***" % hdf_subvol_files_location)
+        return
+    volume_ds_shape = np.array(grid.vol_shape, dtype='uint64')
+    f = h5py.File(input_files[0], 'r')
     # Get the list of segmented datasets
     seg_ds_list = []
     for ds in f.keys():
@@ -104,7 +105,6 @@ def combine_subvols_prob_map():
     seg_ds_list.remove('orig_indices')
     seg_ds_list.remove('right_overlap')
     seg_ds_list.remove('left_overlap')
-    datatype = f[seg_ds_list[0]].dtype
     f.close()
     
     # Create an hdf file to contain the whole volume segmented images for all classes.
@@ -127,63 +127,59 @@ def combine_subvols_prob_map():
         vol_map_file = h5py.File(prob_volume_file, 'w', driver='mpio', comm=comm)
     if rank == 0:
         print("Created Segmented volume file %s and time to create it is %d Sec" % (prob_volume_file, time.time() - create_time))
-    iterations = int(len(input_files) / size) + (len(input_files) % size > 0)
+    # Sub-volume files of this rank, see tile_traversal and tile_assignment.
+    tile_files = dict(zip(tiles, input_files))
+    my_tiles = grid.rank_tiles(tiles, rank, size)
     if rank == 0:
-        print("iterations is ", iterations)
+        print("Number of sub-volumes of rank 0 is ", len(my_tiles))
     # Combine all datasets in the subvolume into the whole volume file.
     for ds in range(len(seg_ds_list)):
         print("Working on subvolume segmented class %s" % seg_ds_list[ds])
         ds_time = time.time()
-        vol_seg_dataset = vol_map_file.create_dataset(seg_ds_list[ds], volume_ds_shape, dtype=datatype,
-                                                      chunks=(1, il_sub_vol_y, il_sub_vol_z))
+        # The volume maps are encoded as prob_map_dtype, whatever the encoding of the sub-volume maps.
+        vol_seg_dataset = create_prob_map_dataset(vol_map_file, seg_ds_list[ds], volume_ds_shape,
+                                                  chunks=(1,) + grid.tile_shape[1:])
         if rank == 0:
             print("Dataset creation time is %d Sec" % (time.time() - ds_time))
             print("Working on subvolume segmented class %s" % seg_ds_list[ds])
-        for idx in range(iterations):
+        # The sub-volumes are read by the executor's workers, this process writes them, see executor.py.
+        subvol_cores = executor.imap(_read_subvol_core, my_tiles, tile_files, seg_ds_list[ds], grid)
+        for idx, (tile, subvoldata) in enumerate(subvol_cores):
             if idx == 0:
                 print("start to combine a dataset to whole volume, dataset is %s, rank is %d, time %s" % 
                       (seg_ds_list[ds], rank, (time.ctime(time.time()))))
-            if (rank + (size * idx)) >= len(input_files):
-                print("\nBREAKING out, my rank is %d, number of files is %d, size is %d and idx is %d" %
-                      (rank, len(input_files), size, idx))
-                break
-            subvol_file = h5py.File(input_files[rank + (size * idx)], 'r')
-            # Retrieve indices into the whole volume. 
-            orig_idx_ds = subvol_file['orig_indices']
-            orig_idx = orig_idx_ds[...]
-            
-            # Retrieve overlap size to the right and left side of the sub-volume.
-            right_overlapds = subvol_file['right_overlap']
-            rightoverlap = right_overlapds[...]
-            left_overlapds = subvol_file['left_overlap']
-            leftoverlap = left_overlapds[...]
-            
-            start_subvol_ds = time.time()
-            dataset = subvol_file[seg_ds_list[ds]]
-            subvoldata = dataset[...] 
-            x_dim = subvoldata.shape[0]
-            y_dim = subvoldata.shape[1]
-            z_dim = subvoldata.shape[2]
-            print("subvol dimension, rightoverlap and leftoverlap are", subvoldata.shape, rightoverlap, leftoverlap)
-            print("\n subvolume dataset Read time is %d Sec, rank is %d file is %s" % 
-                  ((time.time() - start_subvol_ds), rank, input_files[rank + (size * idx)]))
             ds_write = time.time()
-            vol_seg_dataset[orig_idx[0]:orig_idx[1], orig_idx[2]:orig_idx[3], orig_idx[4]:orig_idx[5]] = \
-                subvoldata[leftoverlap[0] : x_dim - rightoverlap[0], 
-                           leftoverlap[1] : y_dim - rightoverlap[1], 
-                           leftoverlap[2] : z_dim - rightoverlap[2]]
+            vol_seg_dataset[grid.core_box(tile)] = subvoldata
             print("Time to write a subvolume ds is  %d Sec and rank is %d" % ((time.time() - ds_write), rank))
-            subvol_file.close()
         
         comm.Barrier()
         
         print("Time to combine one dataset to whole volume is %d Sec,  dataset is %s, rank is %d, time %s" % 
               ((time.time() - ds_time), seg_ds_list[ds], rank, (time.ctime(time.time()))))
+    executor.close()
     vol_map_file.close()
     end_time = time.time()
     if rank % 1 == 0:
         print(" DONE - Volume dataset shape is", volume_ds_shape)
         print("Exec time for combine_segmented_subvols() is %d Sec and rank is %d" % ((time.time() - start_time), rank))
 
+
+def _read_subvol_core(tile, tile_files, ds_name, grid):
+    """
+    Returns the tile and the core of its dataset ds_name, without the overlaps, read from its sub-volume file
+    and encoded as prob_map_dtype. A map already encoded as prob_map_dtype is returned as stored.
+    """
+    start_subvol_ds = time.time()
+    subvol_file = h5py.File(tile_files[tile], 'r')
+    subvol_dataset = subvol_file[ds_name]
+    encoding = prob_map_encoding(subvol_dataset)
+    subvoldata = subvol_dataset[grid.core_in_halo(tile)]
+    subvol_file.close()
+    if encoding != prob_map_dtype.lower():
+        subvoldata = encode_prob_map(decode_prob_map(subvoldata, encoding))
+    print("subvol core dimension, rightoverlap and leftoverlap are", subvoldata.shape, grid.right[tile], grid.left[tile])
+    print("\n subvolume dataset Read time is %d Sec, file is %s" % ((time.time() - start_subvol_ds), tile_files[tile]))
+    return tile, subvoldata
+
 if __name__ == '__main__':
     combine_subvols_prob_map()
@@ -63,7 +63,8 @@ from segmentation_param import *
 __author__ = "Mehdi Tondravi"
 __copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
-__all__ = ['segment_pixels']
+__all__ = ['create_segmented_subvol',
+           'SegmentedSubvolWriter']
 
 def create_segmented_subvol(subvol_im, pixel_masks, filename, orig_idx_data, rightoverlap_data, leftoverlap_data, seg_output):
     """ 
@@ -87,29 +88,55 @@ def create_segmented_subvol(subvol_im, pixel_masks, filename, orig_idx_data, rig
     """
     
     start_time = time.time()
-    ilastik_classes = get_ilastik_labels()
-    print("Ilastik classes are ", ilastik_classes)
-    im_out_filename = outimage_file_location + '/subvol_' + filename + '.h5'
-    seg_im_file = h5py.File(im_out_filename, 'w')
-    # Save sub-volume indices 
-    subvol_indx = seg_im_file.create_dataset('orig_indices', (6,), dtype='uint64')
-    subvol_indx[...] = orig_idx_data
-    # Save sub-volume right and left side overlaps.
-    subvol_rightoverlap = seg_im_file.create_dataset('right_overlap', (3,), dtype='uint8')
-    subvol_rightoverlap[...] = rightoverlap_data
-    subvol_leftoverlap = seg_im_file.create_dataset('left_overlap', (3,), dtype='uint8')
-    subvol_leftoverlap[...] = leftoverlap_data
-    
-    for label in range(len(ilastik_classes)):
-        seg_im_ds = seg_im_file.create_dataset(ilastik_classes[label], subvol_im.shape, subvol_im.dtype)
-        multiply_time = time.time()
-        if seg_output == True:
-            seg_im_ds[...] = pixel_masks[..., label]
-        else:
-            seg_im_ds[...] = subvol_im * pixel_masks[..., label]
-        print("Multiply time for one dataset is %d Sec" % (time.time() - multiply_time))
-        
-    seg_im_file.close()
+    seg_writer = SegmentedSubvolWriter(subvol_im.shape, subvol_im.dtype, filename, orig_idx_data,
+                                       rightoverlap_data, leftoverlap_data, seg_output)
+    seg_writer.write(0, subvol_im, pixel_masks)
+    seg_writer.close()
     end_time = time.time()
     print("Exec time for create_segmented_subvol is %d Sec" % ((end_time - start_time)))
     return
+
+
+class SegmentedSubvolWriter(object):
+    """
+    Writes the segmented hdf5 file of a sub-volume one x-block at a time, see create_segmented_subvol().
+    The file and its datasets, of the shape and dtype of the sub-volume image, are created by the
+    constructor, the blocks are written by write() and the file is closed by close().
+    """
+    
+    def __init__(self, shape, dtype, filename, orig_idx_data, rightoverlap_data, leftoverlap_data, seg_output):
+        ilastik_classes = get_ilastik_labels()
+        print("Ilastik classes are ", ilastik_classes)
+        self.seg_output = seg_output
+        im_out_filename = outimage_file_location + '/subvol_' + filename + '.h5'
+        self.seg_im_file = h5py.File(im_out_filename, 'w')
+        # Save sub-volume indices 
+        subvol_indx = self.seg_im_file.create_dataset('orig_indices', (6,), dtype='uint64')
+        subvol_indx[...] = orig_idx_data
+        # Save sub-volume right and left side overlaps.
+        subvol_rightoverlap = self.seg_im_file.create_dataset('right_overlap', (3,), dtype='uint8')
+        subvol_rightoverlap[...] = rightoverlap_data
+        subvol_leftoverlap = self.seg_im_file.create_dataset('left_overlap', (3,), dtype='uint8')
+        subvol_leftoverlap[...] = leftoverlap_data
+        self.seg_im_ds = [self.seg_im_file.create_dataset(label_name, shape, dtype)
+                          for label_name in ilastik_classes]
+    
+    def write(self, x_start, subvol_im, pixel_masks):
+        """
+        Writes the segmented images of the x-block of the sub-volume starting at slice x_start, from the
+        image and the pixel masks of the block.
+        """
+        block = slice(x_start, x_start + subvol_im.shape[0])
+        for label, seg_im_ds in enumerate(self.seg_im_ds):
+            multiply_time = time.time()
+            if self.seg_output == True:
+                seg_im_ds[block] = pixel_masks[..., label]
+            else:
+                seg_im_ds[block] = subvol_im * pixel_masks[..., label]
+            print("Multiply time for one dataset is %d Sec" % (time.time() - multiply_time))
+    
+    def close(self):
+        """
+        Closes the segmented file.
+        """
+        self.seg_im_file.close()
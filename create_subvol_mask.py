@@ -55,7 +55,6 @@ from __future__ import (absolute_import, division, print_function,
 import pdb
 import numpy as np
 import h5py
-from mpi4py import MPI
 import os.path
 from glob import glob
 import time
@@ -0,0 +1,232 @@
+#!/usr/bin/env python 
+
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+Executors that run the work of a pipeline stage: MPI ranks, or a driver process with a pool of local worker
+processes that needs neither MPI nor Parallel HDF.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from collections import deque
+import itertools
+import multiprocessing
+import socket
+from segmentation_param import *
+
+if executor_backend.lower() == 'local':
+    MPI = None
+else:
+    from mpi4py import MPI
+
+__author__ = "Mehdi Tondravi"
+__copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['MPI',
+           'SerialComm',
+           'MPIExecutor',
+           'LocalExecutor',
+           'get_executor']
+
+# Arguments of the function mapped by the workers of a LocalExecutor, see _init_worker().
+_worker_args = ()
+
+
+class SerialComm(object):
+    """
+    The communicator of a stage run as a single rank by the local backend, the collective operations return
+    the value of the one rank.
+    """
+    
+    def Get_rank(self):
+        return 0
+    
+    def Get_size(self):
+        return 1
+    
+    def Barrier(self):
+        pass
+    
+    def bcast(self, obj, root=0):
+        return obj
+    
+    def gather(self, obj, root=0):
+        return [obj]
+    
+    def allgather(self, obj):
+        return [obj]
+    
+    def allreduce(self, obj, op=None):
+        return obj
+    
+    def Reduce(self, sendbuf, recvbuf, op=None, root=0):
+        recvbuf[...] = sendbuf
+    
+    def Allreduce(self, sendbuf, recvbuf, op=None):
+        recvbuf[...] = sendbuf
+    
+    def Split_type(self, split_type, key=0):
+        return self
+    
+    def Free(self):
+        pass
+
+
+class _SerialMPI(object):
+    """
+    The names of mpi4py.MPI used by the stages, for the local backend that does not load MPI.
+    """
+    SUM = 'sum'
+    MIN = 'min'
+    MAX = 'max'
+    COMM_TYPE_SHARED = 0
+    THREAD_MULTIPLE = 3
+    COMM_WORLD = SerialComm()
+    
+    @staticmethod
+    def Get_processor_name():
+        return socket.gethostname()
+    
+    @staticmethod
+    def Query_thread():
+        return _SerialMPI.THREAD_MULTIPLE
+
+
+if MPI is None:
+    MPI = _SerialMPI
+
+
+class MPIExecutor(object):
+    """
+    Every MPI rank runs the stage on its share of the work, imap() runs the work of a rank in the rank.
+    """
+    backend = 'mpi'
+    processes = 1
+    
+    def __init__(self):
+        self.comm = MPI.COMM_WORLD
+    
+    def imap(self, func, items, *args):
+        """
+        Yields func(item, *args) for the items in order.
+        """
+        for item in items:
+            yield func(item, *args)
+    
+    def close(self):
+        """
+        Nothing to release, see LocalExecutor.close().
+        """
+        pass
+
+
+class LocalExecutor(object):
+    """
+    The stage runs as a single rank, see SerialComm, in a driver process. imap() hands the items to a pool of
+    worker processes and yields the results to the driver, so the driver is the only process writing to a
+    shared HDF5 file: workers read their input and return what is to be written.
+    
+    Workers are started with spawn so that they do not inherit the open HDF5 files of the driver, and open
+    the files they read themselves. The pool is started by the first imap() and kept for the following ones
+    until close() is called at the end of the stage.
+    """
+    backend = 'local'
+    
+    def __init__(self, processes):
+        self.comm = SerialComm()
+        self.processes = max(int(processes), 1)
+        self._pool = None
+    
+    def imap(self, func, items, *args):
+        """
+        Yields func(item, *args) for the items in order. The calls are made by the processes worker processes
+        of the pool, at most two items per worker ahead of the consumer. func must be a module level function,
+        func and args are pickled to the workers with each item.
+        """
+        if self._pool is None:
+            self._pool = multiprocessing.get_context('spawn').Pool(self.processes)
+        queue_depth = 2 * self.processes
+        item_iter = iter(items)
+        pending = deque()
+        try:
+            for item in itertools.islice(item_iter, queue_depth):
+                pending.append(self._pool.apply_async(_call_worker, (func, item, args)))
+            while pending:
+                result = pending.popleft().get()
+                for item in itertools.islice(item_iter, 1):
+                    pending.append(self._pool.apply_async(_call_worker, (func, item, args)))
+                yield result
+        finally:
+            # Items still worked on when the consumer stops, or a call fails, are dropped with the pool.
+            if pending:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+    
+    def close(self):
+        """
+        Stops the worker processes of the pool, a later imap() starts a new pool.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def _call_worker(func, item, args):
+    return func(item, *args)
+
+
+def get_executor():
+    """
+    Returns the executor of the stages as set by executor_backend in the seg_user_param.py file, 'mpi' or
+    'local' with local_processes worker processes, all cores if it is blank.
+    """
+    if executor_backend.lower() == 'local':
+        return LocalExecutor(int(local_processes) if local_processes else no_of_threads)
+    return MPIExecutor()
@@ -55,11 +55,15 @@ from __future__ import (absolute_import, division, print_function,
 import pdb
 import numpy as np
 import h5py
-from mpi4py import MPI
+from executor import MPI, get_executor
 import os.path
+import math
 from glob import glob
 import time
 from segmentation_param import *
+from tile_grid import TileGrid
+from tile_planner import bytes_per_voxel, classifier_halo, rank_memory_mb, plan_tile_shape
+from volume_backend import open_volume, process_volume, read_volume_box
 
 __author__ = "Mehdi Tondravi"
 __copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
@@ -71,6 +75,7 @@ def compute_sub_volumes(dataset_shape):
     """
     This function divides a given volume image into sub-volumes and returns three lists. Each list has the
     start and end indices for a sub-volume. The sub-volume size is specified in the seg_user_param.py file. 
+    The stages use the TileGrid of tile_grid.py, this function returns its tiles in the list format.
     
     Parameters
     ----------
@@ -81,62 +86,39 @@ def compute_sub_volumes(dataset_shape):
     x,y,z list of indices
     
     """
-    x_sub_volumes_idx = []
-    y_sub_volumes_idx = []
-    z_sub_volumes_idx = []
-    # il_sub_vol_x, il_sub_vol_y and il_sub_vol_z are user option and specified in segmentation_param.py file.
-    for x_idx in range(int(dataset_shape[0] / il_sub_vol_x) + (dataset_shape[0] % il_sub_vol_x > 0)):
-        for y_idx in range(int(dataset_shape[1] / il_sub_vol_y) + (dataset_shape[1] % il_sub_vol_y > 0)):
-            for z_idx in range(int(dataset_shape[2] / il_sub_vol_z) + (dataset_shape[2] % il_sub_vol_z > 0)):
-                x_next_idx = []
-                if (il_sub_vol_x + il_sub_vol_x * x_idx) < dataset_shape[0]:
-                    x_next_idx.append(((il_sub_vol_x * x_idx), (il_sub_vol_x + il_sub_vol_x * x_idx)))
-                else:
-                    x_next_idx.append(((il_sub_vol_x * x_idx), (dataset_shape[0])))
-                x_sub_volumes_idx.append(x_next_idx)
-                
-                y_next_idx = []
-                if (il_sub_vol_y + il_sub_vol_y * y_idx) < dataset_shape[1]:
-                    y_next_idx.append(((il_sub_vol_y * y_idx), (il_sub_vol_y + il_sub_vol_y * y_idx)))
-                else:
-                    y_next_idx.append(((il_sub_vol_y * y_idx), (dataset_shape[1])))
-                y_sub_volumes_idx.append(y_next_idx)
-                
-                z_next_idx = []
-                if (il_sub_vol_z + il_sub_vol_z * z_idx) < dataset_shape[2]:
-                    z_next_idx.append(((il_sub_vol_z * z_idx), (il_sub_vol_z + il_sub_vol_z * z_idx)))
-                else:
-                    z_next_idx.append(((il_sub_vol_z * z_idx), (dataset_shape[2])))
-                z_sub_volumes_idx.append(z_next_idx)
+    grid = TileGrid(dataset_shape)
+    x_sub_volumes_idx = [[(int(start), int(stop))] for start, stop in zip(grid.start[:, 0], grid.stop[:, 0])]
+    y_sub_volumes_idx = [[(int(start), int(stop))] for start, stop in zip(grid.start[:, 1], grid.stop[:, 1])]
+    z_sub_volumes_idx = [[(int(start), int(stop))] for start, stop in zip(grid.start[:, 2], grid.stop[:, 2])]
     return x_sub_volumes_idx, y_sub_volumes_idx, z_sub_volumes_idx
 
 def make_subvolume_mpi():
     """ 
     Volume image is divided into several overlapping sub-volumes and each sub-volume image
-    is written to a HDF file. 
+    is written to a HDF file. The tile grid of the sub-volumes is written to tile_grid_file for the
+    later stages. When subvol_mode is 'direct' only the tile grid is written, the classification stage
+    reads the sub-volumes from the volume.
+    With subvol_read_mode 'slab' the sub-volumes are cut from x-slabs of the volume that are read once.
+    When skip_background_tiles is 'yes' the background sub-volumes are flagged in the grid and not written.
     
     Input: The volume cell probability map file location is specified in the segmentation_param.py file. 
     
     Output: Vessel maps are written into a new data set created within the input file.                         
     """
     
-    comm = MPI.COMM_WORLD
+    executor = get_executor()
+    comm = executor.comm
     rank = comm.Get_rank()
-    size = MPI.COMM_WORLD.Get_size()
+    size = comm.Get_size()
     name = MPI.Get_processor_name()
     start_time = time.time()
     if rank == 0:
         print("*** Time is %d Entered make_subvolume_mpi() and Size is %d****" % (time.time(), size))
-    # assumes volume image file extension is .hdf5 
-    hdf5_vol_file = sorted(glob(hdf_files_location + '/*.hdf5'))
-    if not hdf5_vol_file:
-        print("*** Did not find volume file ending with .hdf5 extension  ***")
-        return
     # Remove all *.hdf5 sub-volume image files from previous runs. Create containing directory if it does not exist.
     if rank == 0:
         print("*** Ilastik input/output file location is ***", hdf_subvol_files_location)
         if os.path.exists(hdf_subvol_files_location):
-            hdf5_subvol_files =  glob(hdf_subvol_files_location + '/*.hdf5')
+            hdf5_subvol_files =  glob(hdf_subvol_files_location + '/*.hdf5') + glob(tile_grid_file)
             for file in hdf5_subvol_files:
                 print("*** Removing file ***", file)
                 os.remove(file)
@@ -145,120 +127,234 @@ def make_subvolume_mpi():
             os.mkdir(hdf_subvol_files_location)
     comm.Barrier()
     
-    # Need Parallel HDF for faster processing. However the below test lets processing to continue even if
-    # Parallel HDF is not available.
-    if size == 1:
-        vol_file = h5py.File(hdf5_vol_file[0], 'r')
-    else:
-        vol_file = h5py.File(hdf5_vol_file[0], 'r', driver='mpio', comm=comm)
-    parent_dir, tiff_dir = os.path.split(tiff_files_location)
-    vol_dataset = vol_file[tiff_dir]
+    # The volume is the hdf5 volume file or the TIFF files, depending on volume_backend.
+    vol_file, vol_dataset = open_volume(comm)
+    if vol_dataset is None:
+        return
     vol_shape = vol_dataset.shape
     if rank == 0:
         print("Volume Image Shape and data type is", vol_dataset.shape, vol_dataset.dtype)
-    # Compute the sub-volumes indices
-    x_sub_volumes_idx, y_sub_volumes_idx, z_sub_volumes_idx = compute_sub_volumes(vol_dataset.shape)
+    # Compute the sub-volumes indices, the overlap is derived from the classifier's feature scales.
+    overlap = classifier_halo() if rank == 0 else None
+    overlap = comm.bcast(overlap, root=0)
+    if rank == 0:
+        print("Sub-volume overlap is %d pixels" % overlap)
+    tile_shape = None
+    if auto_tile_size.upper() == 'YES':
+        voxel_bytes = bytes_per_voxel() if rank == 0 else None
+        voxel_bytes = comm.bcast(voxel_bytes, root=0)
+        # The memory of a rank is shared by its worker processes with the local executor.
+        memory_mb = rank_memory_mb(comm) // executor.processes
+        tile_shape = plan_tile_shape(vol_shape, memory_mb, voxel_bytes, overlap)
+        if tile_shape is None:
+            print("AVAILABLE MEMORY OF %d MB IS NOT BIG ENOUGH FOR A SUB-VOLUME WITH %d PIXELS OVERLAP" % (memory_mb, overlap))
+            if vol_file is not None:
+                vol_file.close()
+            return
+        if rank == 0:
+            print("Planned sub-volume shape is %s for %d MB per rank and %.1f bytes per voxel" %
+                  (tile_shape, memory_mb, voxel_bytes))
+    grid = TileGrid(vol_shape, tile_shape, overlap)
+    if skip_background_tiles.upper() == 'YES':
+        _flag_background_tiles(grid, vol_file, vol_dataset, executor)
+    if rank == 0:
+        grid.save(tile_grid_file)
+        halo_voxels = np.prod(grid.stop + grid.right - grid.start + grid.left, axis=1).sum()
+        core_voxels = np.prod(grid.stop - grid.start, axis=1).sum()
+        print("Saved grid of %d sub-volumes of shape %s in %s, classified voxels are %.2f times the volume" %
+              (len(grid), grid.tile_shape, tile_grid_file, halo_voxels / core_voxels))
     if rank % 6 == 0:
         print("Done with computing sub-volumes - This is rank %d of %d running on %s" % (rank, size, name))
     
-    # Figure out how many sub-volumes should be handled by each rank/process.
-    iterations = int(len(x_sub_volumes_idx) / size) + (len(x_sub_volumes_idx) % size > 0)
-    partial_iterations = int(len(x_sub_volumes_idx) % size)
+    if subvol_mode.upper() == 'DIRECT':
+        executor.close()
+        if vol_file is not None:
+            vol_file.close()
+        return
+    
+    if subvol_read_mode.upper() == 'SLAB':
+        _make_subvolumes_from_slabs(grid, vol_dataset, executor)
+    else:
+        _make_subvolumes_from_tiles(grid, vol_dataset, executor)
+    executor.close()
+    if vol_file is not None:
+        vol_file.close()
+    end_time = time.time()
+    if rank % 6 == 0:
+        print("Sub-volume Exec time is %d Sec" % (end_time - start_time))
+
+def _make_subvolumes_from_tiles(grid, vol_dataset, executor):
+    """
+    Each rank reads its sub-volumes, the tiles that are not background given to it by grid.rank_tiles(),
+    from the volume one at a time. With the local executor the sub-volumes are made by its worker processes.
+    """
+    comm = executor.comm
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    tiles = grid.foreground_tiles()
+    my_tiles = grid.rank_tiles(tiles, rank, size)
     if rank == 0:
-        print("Number of Subvolumes is %d, iterations is %d, partial_iterations is %d" % 
-              (len(x_sub_volumes_idx), iterations, partial_iterations))
-    for idx in range(iterations):
+        print("Number of Subvolumes is %d, tile order is %s and tile assignment is %s" % 
+              (len(tiles), tile_traversal, tile_assignment))
+    # Worker processes of the local executor open the volume themselves.
+    worker_dataset = vol_dataset if executor.backend == 'mpi' else None
+    for idx, read_time in enumerate(executor.imap(_make_tile_subvolume, my_tiles, grid, worker_dataset)):
         if rank % 6 == 0:
             print("*** Time is %d, rank is %d ***" % (time.time(), rank))
-        if (rank + (size * idx)) >= len(x_sub_volumes_idx):
-            print("\nBREAKING out, my rank is %d, number of subvolume is %d, size is %d,  and idx is %d" % 
-                  (rank, len(x_sub_volumes_idx), size, idx))
-            break
-        x_idx = x_sub_volumes_idx[rank + (size * idx)]
-        y_idx = y_sub_volumes_idx[rank + (size * idx)]
-        z_idx = z_sub_volumes_idx[rank + (size * idx)]
-        filenumber = str(rank + size * idx).zfill(5)
-        subvol_filename = hdf_subvol_files_location + '/' + tiff_dir + filenumber + '.hdf5'
-        print("rank is %d, idx is %d, size is %d, file name is %s" % (rank, idx, size, subvol_filename))
-        subvolfile = h5py.File(subvol_filename, 'w')
-        
-        # Determine pixels overlap to the right side of the sub-volume.
-        if (x_idx[0][1] + pixeloverlap) < vol_shape[0]:
-            x_rightoverlap = pixeloverlap
-        else:
-            x_rightoverlap = 0
-        
-        if (y_idx[0][1] + pixeloverlap) < vol_shape[1]:
-            y_rightoverlap = pixeloverlap
-        else:
-            y_rightoverlap = 0
-        
-        if (z_idx[0][1] + pixeloverlap) < vol_shape[2]:
-            z_rightoverlap = pixeloverlap
-        else:
-            z_rightoverlap = 0
-        
-        # Determine pixels overlap to the left side of the sub-volume.
-        if (x_idx[0][0] > pixeloverlap):
-            x_leftoverlap = pixeloverlap
-        else:
-            x_leftoverlap = 0
-        
-        if (y_idx[0][0] > pixeloverlap):
-            y_leftoverlap = pixeloverlap
-        else:
-            y_leftoverlap = 0
-        
-        if (z_idx[0][0] > pixeloverlap):
-            z_leftoverlap = pixeloverlap
-        else:
-            z_leftoverlap = 0
-        
-        x_shape = x_idx[0][1] - x_idx[0][0] + x_rightoverlap + x_leftoverlap
-        y_shape = y_idx[0][1] - y_idx[0][0] + y_rightoverlap + y_leftoverlap
-        z_shape = z_idx[0][1] - z_idx[0][0] + z_rightoverlap + z_leftoverlap
-
-        subvol_dataset = subvolfile.create_dataset((tiff_dir + filenumber), (x_shape, y_shape, z_shape), vol_dataset.dtype)
-        
-        start_subvol_time = time.time()
-        rows_count = (x_idx[0][1]+x_rightoverlap) - (x_idx[0][0]-x_leftoverlap)
-        for row in range(rows_count):
-            subvol_dataset[row,:,:] = vol_dataset[x_idx[0][0]-x_leftoverlap + row,
-                                                  y_idx[0][0]-y_leftoverlap : y_idx[0][1]+y_rightoverlap, 
-                                                  z_idx[0][0]-z_leftoverlap : z_idx[0][1]+z_rightoverlap] 
-        end_subvol_time = time.time()
-        # Save original indices and shape in datasets
-        subvol_indx = subvolfile.create_dataset('orig_indices', (6,), dtype='uint64')
-        subvol_indx[0] = x_idx[0][0]
-        subvol_indx[1] = x_idx[0][1]
-        subvol_indx[2] = y_idx[0][0]
-        subvol_indx[3] = y_idx[0][1]
-        subvol_indx[4] = z_idx[0][0]
-        subvol_indx[5] = z_idx[0][1]
-        right_overlapds = subvolfile.create_dataset('right_overlap', (3,), dtype='uint8')
-        
-        # Save overlap value to the right and left
-        right_overlapds[0] = x_rightoverlap
-        right_overlapds[1] = y_rightoverlap
-        right_overlapds[2] = z_rightoverlap
-        left_overlapds = subvolfile.create_dataset('left_overlap', (3,), dtype='uint8')
-        left_overlapds[0] = x_leftoverlap
-        left_overlapds[1] = y_leftoverlap
-        left_overlapds[2] = z_leftoverlap
-        
         if idx < 100:
-            if rank % 1 == 0:
-                print("rank is %d and Sub-volume shape is x, y, z  %d:%d, %d:%d, %d:%d" % 
-                      (rank, x_idx[0][0], x_idx[0][1], y_idx[0][0], y_idx[0][1], z_idx[0][0], z_idx[0][1]))
-                print("Sub-volume file name is %s, dataset name is %s" % (subvol_filename, subvol_dataset.name))
-        
-        if idx < 100:
-            print("Exec time for read from disk is %d Sec and rank is %d" % ((end_subvol_time - start_subvol_time), rank))
-        subvolfile.close()
-    vol_file.close()
-    end_time = time.time()
-    if rank % 6 == 0:
-        print("Sub-volume Exec time is %d Sec" % (end_time - start_time))
+            print("Exec time for read from disk is %d Sec and rank is %d" % (read_time, rank))
+
+
+def _make_tile_subvolume(tile, grid, vol_dataset):
+    """
+    Reads a sub-volume from the volume and writes its sub-volume file, returns the read time. The volume is
+    opened by this process if vol_dataset is None.
+    """
+    if vol_dataset is None:
+        vol_dataset = process_volume()
+    start_subvol_time = time.time()
+    subvol_data = read_volume_box(vol_dataset, *grid.halo_box(tile))
+    end_subvol_time = time.time()
+    _write_subvol_file(grid, tile, subvol_data, tile < 100)
+    return end_subvol_time - start_subvol_time
+
+
+def _make_subvolumes_from_slabs(grid, vol_dataset, executor):
+    """
+    The tiles with the same x grid coordinate form a slab. A rank reads the halo padded box of a slab, or of
+    a band of the slab along y when the slab is larger than subvol_slab_mb, with one read and cuts the
+    sub-volumes of the slab from memory. The (slab, band) units are divided among ranks, and among the
+    worker processes with the local executor.
+    """
+    comm = executor.comm
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    # Background tiles are left out, bands without other tiles are not read.
+    units = [tiles[~grid.background[tiles]] for tiles in
+             _slab_units(grid, vol_dataset.dtype.itemsize, size * executor.processes)]
+    units = [tiles for tiles in units if len(tiles) > 0]
+    my_units = units[rank::size]
+    if rank == 0:
+        print("Number of Subvolumes is %d, number of slabs is %d, number of slab bands is %d" %
+              (len(grid), grid.grid_shape[0], len(units)))
+    read_bytes = 0
+    # Worker processes of the local executor open the volume themselves.
+    worker_dataset = vol_dataset if executor.backend == 'mpi' else None
+    for tiles, band_bytes, read_time, write_time in executor.imap(_make_band_subvolumes, my_units, grid, worker_dataset):
+        read_bytes += band_bytes
+        print("rank is %d, slab %d, tiles %d:%d, read time is %d Sec, write time is %d Sec" %
+              (rank, grid.ijk[tiles[0], 0], tiles[0], tiles[-1] + 1, read_time, write_time))
+    print("rank is %d, read %.1f MB from the volume for %d bands" % (rank, read_bytes / 1e6, len(my_units)))
+
+
+def _make_band_subvolumes(tiles, grid, vol_dataset):
+    """
+    Reads the halo padded box of a (slab, band) unit and writes the sub-volume files of its tiles. Returns
+    the tiles, the bytes read and the read and write times. The volume is opened by this process if
+    vol_dataset is None.
+    """
+    if vol_dataset is None:
+        vol_dataset = process_volume()
+    start_slab_time = time.time()
+    # Halo padded box of the band, the halos of its tiles along y and the whole volume along z.
+    band_start = np.min([grid.halo_box(tile)[0] for tile in tiles], axis=0)
+    band_stop = np.max([grid.halo_box(tile)[1] for tile in tiles], axis=0)
+    band_data = read_volume_box(vol_dataset, band_start, band_stop)
+    end_slab_time = time.time()
+    for tile in tiles:
+        halo_start, halo_stop = grid.halo_box(tile)
+        _write_subvol_file(grid, tile, band_data[tuple(slice(int(lo), int(hi)) for lo, hi in
+                                                       zip(halo_start - band_start, halo_stop - band_start))], tile < 100)
+    return tiles, band_data.nbytes, end_slab_time - start_slab_time, time.time() - end_slab_time
+
+
+def _flag_background_tiles(grid, vol_file, vol_dataset, executor):
+    """
+    Flags the background tiles of the grid, see background_tile(). The tiles are divided among ranks. When
+    the volume file has a pyramid, a tile with a block of its coarsest level above background_threshold
+    has foreground and is not read, the other tiles are read to decide, by the worker processes with the
+    local executor.
+    """
+    comm = executor.comm
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    start_time = time.time()
+    factor = None
+    if vol_file is not None and 'pyramid' in vol_file and background_max_std == '':
+        factor = max(vol_file['pyramid'][level].attrs['downsample_factor'] for level in vol_file['pyramid'])
+        level_data = vol_file['pyramid/%dx' % factor][...]
+    my_tiles = grid.rank_tiles(np.arange(len(grid)), rank, size)
+    my_flags = [False] * len(my_tiles)
+    read_idx = []
+    for idx, tile in enumerate(my_tiles):
+        if factor is not None:
+            # A block mean above the threshold needs a voxel above the threshold.
+            halo_start, halo_stop = grid.halo_box(tile)
+            level_box = tuple(slice(int(lo) // factor, -(-int(hi) // factor)) for lo, hi in zip(halo_start, halo_stop))
+            if level_data[level_box].max() > background_threshold:
+                continue
+        read_idx.append(idx)
+    # Worker processes of the local executor open the volume themselves.
+    worker_dataset = vol_dataset if executor.backend == 'mpi' else None
+    for idx, flag in zip(read_idx, executor.imap(_read_background_tile, [my_tiles[idx] for idx in read_idx], grid, worker_dataset)):
+        my_flags[idx] = flag
+    read_count = len(read_idx)
+    for rank_tiles, flags in comm.allgather((my_tiles, my_flags)):
+        grid.background[rank_tiles] = flags
+    read_count = comm.allreduce(read_count, op=MPI.SUM)
+    if rank == 0:
+        print("*** %d of %d sub-volumes are background, %d sub-volumes were read, time is %d sec ***" %
+              (grid.background.sum(), len(grid), read_count, (time.time() - start_time)))
+
+
+def _read_background_tile(tile, grid, vol_dataset):
+    """
+    Reads a tile, with its overlap, and returns whether it is background. The volume is opened by this
+    process if vol_dataset is None.
+    """
+    if vol_dataset is None:
+        vol_dataset = process_volume()
+    return bool(background_tile(read_volume_box(vol_dataset, *grid.halo_box(tile))))
+
+
+def _slab_units(grid, itemsize, size):
+    """
+    Returns the tile numbers of each (slab, band) unit. A slab is divided along y into bands of whole tiles
+    that are at most subvol_slab_mb, and into at least as many bands as needed to give every rank a unit.
+    """
+    slab_count = grid.grid_shape[0]
+    y_tiles = grid.grid_shape[1]
+    min_bands = min(y_tiles, int(math.ceil(size / slab_count)))
+    units = []
+    for slab in range(slab_count):
+        slab_tiles = np.flatnonzero(grid.ijk[:, 0] == slab)
+        halo_start, halo_stop = grid.halo_box(slab_tiles[0])
+        # Bytes of a halo padded band one tile high along y.
+        row_bytes = (halo_stop[0] - halo_start[0]) * (grid.tile_shape[1] + 2 * grid.overlap) * grid.vol_shape[2] * itemsize
+        band_tiles = max(1, min(int(subvol_slab_mb * 1e6 / row_bytes), int(math.ceil(y_tiles / min_bands))))
+        for band in range(0, y_tiles, band_tiles):
+            in_band = (grid.ijk[slab_tiles, 1] >= band) & (grid.ijk[slab_tiles, 1] < band + band_tiles)
+            units.append(slab_tiles[in_band])
+    return units
+
+
+def _write_subvol_file(grid, tile, subvol_data, verbose):
+    """
+    Writes the image of a sub-volume, with its indices and overlaps, into its sub-volume file.
+    """
+    subvol_filename = hdf_subvol_files_location + '/' + subvol_name(tile) + '.hdf5'
+    subvolfile = h5py.File(subvol_filename, 'w')
+    subvol_dataset = subvolfile.create_dataset(subvol_name(tile), data=subvol_data)
+    # Save original indices and shape in datasets
+    subvolfile.create_dataset('orig_indices', data=grid.orig_indices(tile).astype('uint64'))
+    # Save overlap value to the right and left
+    subvolfile.create_dataset('right_overlap', data=grid.right[tile].astype('uint8'))
+    subvolfile.create_dataset('left_overlap', data=grid.left[tile].astype('uint8'))
+    if verbose:
+        print("Sub-volume shape is x, y, z  %d:%d, %d:%d, %d:%d" % tuple(grid.orig_indices(tile)))
+        print("Sub-volume file name is %s, dataset name is %s" % (subvol_filename, subvol_dataset.name))
+    subvolfile.close()
+
 
 if __name__ == '__main__':
     make_subvolume_mpi()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python 
+
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+Native pixel classifier. The features selected in an Ilastik project and its trained random forests are
+exported from the project file once, the sub-volumes are then classified with scipy filters and numpy without
+loading Ilastik.
+
+Run as a script to export the classifier of the project to native_classifier_file and compare its probability
+maps with the ones of Ilastik on native_validate_tiles sub-volumes.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import time
+import h5py
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
+from segmentation_param import *
+from tile_planner import feature_channels, feature_window_sigmas, read_feature_selection
+
+__author__ = "Mehdi Tondravi"
+__copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['NativeClassifier',
+           'native_classifier',
+           'validate_native_classifier']
+
+# Scales of Ilastik, used when the project file has no scales.
+_default_scales = [0.3, 0.7, 1.0, 1.6, 3.5, 5.0, 10.0]
+# Vigra random forest node types, see vigra/random_forest/rf_nodeproxy.hxx.
+_threshold_node = 0
+_leaf_node_tag = 0x40000000
+# The classifier of this process, see native_classifier().
+_classifier = None
+
+
+class NativeClassifier(object):
+    """
+    The pixel classifier of an Ilastik project, its features and trained random forests.
+
+    Arguments:
+        features: (feature id, scale) of the feature channels, in Ilastik's channel order
+        label_names: names of the label classes, one probability map each
+        nodes: dict of the node arrays of all trees, 'column' and 'threshold' of the split nodes (column is -1
+            for a leaf), 'children' (left, right) and 'probs' (label votes of the leaves)
+        tree_roots: root node of each tree
+        tree_forest: forest of each tree, Ilastik trains several forests in parallel
+    """
+
+    def __init__(self, features, label_names, nodes, tree_roots, tree_forest):
+        self.features = [(str(feature_id), float(scale)) for feature_id, scale in features]
+        self.label_names = list(label_names)
+        self.nodes = nodes
+        self.tree_roots = np.asarray(tree_roots, dtype='int64')
+        self.tree_forest = np.asarray(tree_forest, dtype='int64')
+        self.key = None
+        self.tile_count = 0
+
+    @classmethod
+    def from_ilp(cls, ilp_file):
+        """
+        Exports the classifier of an Ilastik project. The vigra random forests of the project are read
+        from PixelClassification/ClassifierForests with h5py.
+        """
+        feature_selection = read_feature_selection(ilp_file)
+        if feature_selection is None:
+            raise ValueError("No feature selection in %s" % ilp_file)
+        feature_ids, scales, selection = feature_selection
+        if scales is None:
+            scales = _default_scales
+        features = [(feature_id, scale) for feature_id, selected in zip(feature_ids, selection)
+                    for scale, used in zip(scales, selected) if used]
+        for feature_id, scale in features:
+            if feature_id not in _feature_functions:
+                raise ValueError("Feature %s of %s is not supported" % (feature_id, ilp_file))
+        channels = sum(feature_channels[feature_id] for feature_id, scale in features)
+
+        with h5py.File(ilp_file, 'r') as ilp:
+            label_names = [name.decode() if isinstance(name, bytes) else str(name)
+                           for name in ilp['PixelClassification/LabelNames'][...]]
+            if 'PixelClassification/ClassifierForests' not in ilp:
+                raise ValueError("No trained classifier in %s" % ilp_file)
+            forests_group = ilp['PixelClassification/ClassifierForests']
+            forest_names = sorted(name for name in forests_group if name.startswith('Forest'))
+            if not forest_names:
+                raise ValueError("The classifier of %s is not a vigra random forest" % ilp_file)
+            trees = []
+            for forest, forest_name in enumerate(forest_names):
+                forest_group = forests_group[forest_name]
+                ext_param = forest_group['_ext_param']
+                column_count = int(np.ravel(ext_param['column_count_'][...])[0])
+                if column_count != channels:
+                    raise ValueError("The forests of %s use %d feature channels, the feature selection has %d"
+                                     % (ilp_file, column_count, channels))
+                if 'labels' in ext_param:
+                    labels = np.ravel(ext_param['labels'][...]).astype('int64')
+                else:
+                    labels = np.arange(1, int(np.ravel(ext_param['class_count_'][...])[0]) + 1)
+                # The forests are trained with the label values, label l is the probability map l - 1.
+                if labels.min() < 1 or labels.max() > len(label_names):
+                    raise ValueError("The forests of %s have labels %s, the project has %d labels"
+                                     % (ilp_file, labels.tolist(), len(label_names)))
+                for tree_name in sorted(name for name in forest_group if name.startswith('Tree_')):
+                    trees.append((forest, labels, forest_group[tree_name]['topology'][...],
+                                  forest_group[tree_name]['parameters'][...]))
+        nodes, tree_roots = _flatten_trees(trees, len(label_names))
+        print("Exported %d feature channels and %d trees of %d forests from %s" %
+              (channels, len(trees), len(forest_names), ilp_file))
+        return cls(features, label_names, nodes, tree_roots, [forest for forest, _, _, _ in trees])
+
+    def save(self, filename):
+        """
+        Saves the classifier to the HDF5 file filename.
+        """
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('feature_ids', data=np.array([feature_id for feature_id, _ in self.features],
+                                                          dtype=h5py.special_dtype(vlen=str)))
+            f.create_dataset('feature_scales', data=np.array([scale for _, scale in self.features],
+                                                             dtype='float64'))
+            f.create_dataset('label_names', data=np.array(self.label_names, dtype=h5py.special_dtype(vlen=str)))
+            for name, array in self.nodes.items():
+                f.create_dataset('nodes/' + name, data=array)
+            f.create_dataset('tree_roots', data=self.tree_roots)
+            f.create_dataset('tree_forest', data=self.tree_forest)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Returns the classifier saved in the HDF5 file filename.
+        """
+        with h5py.File(filename, 'r') as f:
+            feature_ids = [name.decode() if isinstance(name, bytes) else str(name) for name in f['feature_ids'][...]]
+            label_names = [name.decode() if isinstance(name, bytes) else str(name) for name in f['label_names'][...]]
+            nodes = dict((name, f['nodes/' + name][...]) for name in f['nodes'])
+            return cls(zip(feature_ids, f['feature_scales'][...]), label_names, nodes,
+                       f['tree_roots'][...], f['tree_forest'][...])
+
+    def compute_features(self, input_data, threads=1):
+        """
+        Returns the feature channels of the voxels of input_data, a 3D numpy array, as a (voxels, channels)
+        float32 array. The features are computed in threads threads.
+        """
+        data = np.asarray(input_data, dtype='float32')
+        channels = sum(feature_channels[feature_id] for feature_id, _ in self.features)
+        features = np.empty((data.size, channels), dtype='float32')
+        with ThreadPoolExecutor(max_workers=max(int(threads), 1)) as pool:
+            feature_maps = pool.map(lambda feature: _feature_functions[feature[0]](data, feature[1]), self.features)
+            channel = 0
+            for maps in feature_maps:
+                for feature_map in maps:
+                    features[:, channel] = feature_map.ravel()
+                    channel += 1
+        return features
+
+    def predict(self, features):
+        """
+        Returns the label probabilities, a (voxels, labels) float32 array, of the feature channels of voxels.
+        All trees are walked at once for native_batch_voxels voxels at a time. The votes of the trees of a
+        forest are normalized as by vigra and the forests are averaged weighted by their tree count as by
+        Ilastik. The features are compared with the double thresholds of vigra in float64, a threshold is often
+        the midpoint of two neighbouring float32 feature values.
+        """
+        column = self.nodes['column']
+        threshold = self.nodes['threshold'].astype('float64')
+        children = self.nodes['children']
+        probs = self.nodes['probs']
+        forests = [np.flatnonzero(self.tree_forest == forest) for forest in np.unique(self.tree_forest)]
+        batch_voxels = max(int(native_batch_voxels), 1)
+        label_probs = np.zeros((features.shape[0], probs.shape[1]), dtype='float32')
+        for start in range(0, features.shape[0], batch_voxels):
+            batch = features[start:start + batch_voxels]
+            nodes = np.repeat(self.tree_roots[np.newaxis, :], batch.shape[0], axis=0)
+            split = column[nodes] >= 0
+            while split.any():
+                voxels, trees = np.nonzero(split)
+                split_nodes = nodes[voxels, trees]
+                right = batch[voxels, column[split_nodes]].astype('float64') >= threshold[split_nodes]
+                nodes[voxels, trees] = children[split_nodes, right.astype('int64')]
+                split[voxels, trees] = column[nodes[voxels, trees]] >= 0
+            votes = probs[nodes]
+            for forest_trees in forests:
+                forest_votes = votes[:, forest_trees].sum(axis=1)
+                total = forest_votes.sum(axis=1, keepdims=True)
+                total[total == 0] = 1
+                label_probs[start:start + batch.shape[0]] += forest_votes / total * (len(forest_trees) / len(self.tree_roots))
+        return label_probs
+
+    def classify(self, input_data, threads=1):
+        """
+        Returns the probability maps of the pixels of input_data, a 3D numpy array, with the label
+        probabilities on the last axis as returned by Ilastik.
+        """
+        features = self.compute_features(input_data, threads)
+        prob_maps = self.predict(features).reshape(np.shape(input_data) + (len(self.label_names),))
+        del features
+        self.tile_count += 1
+        print("predictions.dtype, predictions.shape", prob_maps.dtype, prob_maps.shape)
+        return prob_maps
+
+
+def _flatten_trees(trees, label_count):
+    """
+    Returns the nodes of vigra decision trees as flat arrays (see NativeClassifier) and the root node of
+    each tree. trees are (forest, labels, topology, parameters) tuples of the vigra trees.
+
+    The topology of a vigra tree starts with the column and class counts followed by the nodes, the root
+    node first. A split node is (type, parameter address, left child, right child, column), it goes left if
+    the feature in its column is below the threshold at parameter address + 1. A leaf node is (type,
+    parameter address), the class votes start at parameter address + 1.
+    """
+    column, threshold, children, probs, tree_roots = [], [], [], [], []
+    for forest, labels, topology, parameters in trees:
+        topology = np.asarray(topology, dtype='int64')
+        parameters = np.asarray(parameters, dtype='float64')
+        node_ids = {}
+        stack = [2]
+        while stack:
+            address = stack.pop()
+            node_ids[address] = len(column)
+            node_type = int(topology[address])
+            parameter_address = int(topology[address + 1])
+            node_probs = np.zeros(label_count, dtype='float32')
+            if node_type & _leaf_node_tag:
+                if node_type != _leaf_node_tag:
+                    raise ValueError("Random forest leaf node type %#x is not supported" % node_type)
+                node_probs[labels - 1] = parameters[parameter_address + 1:parameter_address + 1 + len(labels)]
+                column.append(-1)
+                threshold.append(0.0)
+                children.append((-1, -1))
+            elif node_type == _threshold_node:
+                column.append(int(topology[address + 4]))
+                threshold.append(parameters[parameter_address + 1])
+                children.append((topology[address + 2], topology[address + 3]))
+                stack.extend([int(topology[address + 3]), int(topology[address + 2])])
+            else:
+                raise ValueError("Random forest node type %d is not supported" % node_type)
+            probs.append(node_probs)
+        tree_roots.append(node_ids[2])
+        # Topology addresses of the children to node numbers, a leaf is its own child.
+        for node in range(tree_roots[-1], len(column)):
+            if column[node] < 0:
+                children[node] = (node, node)
+            else:
+                children[node] = (node_ids[int(children[node][0])], node_ids[int(children[node][1])])
+    nodes = {'column': np.array(column, dtype='int64'),
+             'threshold': np.array(threshold, dtype='float64'),
+             'children': np.array(children, dtype='int64').reshape(-1, 2),
+             'probs': np.array(probs, dtype='float32').reshape(-1, label_count)}
+    return nodes, tree_roots
+
+
+def _gaussian(data, scale, order=0):
+    """
+    Gaussian smoothing, or derivative of the given order per axis, of data with Ilastik's window and the
+    mirrored border of vigra.
+    """
+    return ndimage.gaussian_filter(data, scale, order=order, mode='mirror', truncate=feature_window_sigmas)
+
+
+def _eigenvalues(components):
+    """
+    Returns the eigenvalues, largest first as by vigra, of the symmetric 3x3 matrices of the voxels given by
+    their upper triangle components (xx, xy, xz, yy, yz, zz).
+    """
+    shape = components[0].shape
+    eigenvalues = [np.empty(shape, dtype='float32') for axis in range(3)]
+    flat = [component.ravel() for component in components]
+    batch_voxels = max(int(native_batch_voxels), 1)
+    for start in range(0, flat[0].size, batch_voxels):
+        xx, xy, xz, yy, yz, zz = [component[start:start + batch_voxels] for component in flat]
+        matrices = np.stack([xx, xy, xz, xy, yy, yz, xz, yz, zz], axis=-1).reshape(-1, 3, 3)
+        values = np.linalg.eigvalsh(matrices)
+        for axis in range(3):
+            eigenvalues[axis].ravel()[start:start + batch_voxels] = values[:, 2 - axis]
+    return eigenvalues
+
+
+def _axis_orders(*axes):
+    """
+    Returns the derivative order per axis of the partial derivative along axes.
+    """
+    order = [0, 0, 0]
+    for axis in axes:
+        order[axis] += 1
+    return order
+
+
+def _structure_tensor_eigenvalues(data, scale):
+    """
+    Eigenvalues of the structure tensor, the gradient at scale smoothed at half the scale as by Ilastik.
+    """
+    gradient = [_gaussian(data, scale, _axis_orders(axis)) for axis in range(3)]
+    pairs = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+    return _eigenvalues([_gaussian(gradient[i] * gradient[j], 0.5 * scale) for i, j in pairs])
+
+
+def _hessian_eigenvalues(data, scale):
+    """
+    Eigenvalues of the Hessian of Gaussian at scale.
+    """
+    pairs = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+    return _eigenvalues([_gaussian(data, scale, _axis_orders(i, j)) for i, j in pairs])
+
+
+# Channels of each Ilastik feature of a 3D image at a scale.
+_feature_functions = {
+    'GaussianSmoothing': lambda data, scale: [_gaussian(data, scale)],
+    'LaplacianOfGaussian': lambda data, scale: [ndimage.gaussian_laplace(data, scale, mode='mirror',
+                                                                         truncate=feature_window_sigmas)],
+    'GaussianGradientMagnitude': lambda data, scale: [ndimage.gaussian_gradient_magnitude(
+        data, scale, mode='mirror', truncate=feature_window_sigmas)],
+    'DifferenceOfGaussians': lambda data, scale: [_gaussian(data, scale) - _gaussian(data, 0.66 * scale)],
+    'StructureTensorEigenvalues': _structure_tensor_eigenvalues,
+    'HessianOfGaussianEigenvalues': _hessian_eigenvalues}
+
+
+def native_classifier(classifier):
+    """
+    Returns the native classifier of the Ilastik project classifier for this process. It is loaded by the
+    first call from native_classifier_file, or exported from the project if that file is missing or older
+    than the project.
+    """
+    global _classifier
+    if _classifier is None or _classifier.key != classifier:
+        load_time = time.time()
+        if (os.path.exists(native_classifier_file) and
+                os.path.getmtime(native_classifier_file) >= os.path.getmtime(classifier)):
+            _classifier = NativeClassifier.load(native_classifier_file)
+        else:
+            _classifier = NativeClassifier.from_ilp(classifier)
+        _classifier.key = classifier
+        print("Loaded native classifier of %s in %.2f sec" % (classifier, time.time() - load_time))
+    return _classifier
+
+
+def validate_native_classifier(native, tile_count=native_validate_tiles):
+    """
+    Classifies tile_count sub-volumes, spread over the foreground sub-volumes of the grid, with Ilastik and
+    with the native classifier and prints how well the two agree: the fraction of voxels with the same most
+    probable label and the largest and mean probability differences. Returns the smallest label agreement.
+    """
+    from executor import SerialComm
+    from ilastik_session import ilastik_session
+    from tile_grid import TileGrid
+    from tile_planner import rank_memory_mb
+    from volume_backend import process_volume, read_volume_box
+
+    if not os.path.exists(tile_grid_file):
+        print("*** Did not find the sub-volume grid file %s ***" % tile_grid_file)
+        return None
+    grid = TileGrid.load(tile_grid_file)
+    sample = grid.sample_tiles(int(tile_count))
+    if len(sample) == 0:
+        return None
+    vol_dataset = process_volume()
+    ram = rank_memory_mb(SerialComm())
+    agreement = 1.0
+    for tile in sample:
+        subvol_data = read_volume_box(vol_dataset, *grid.halo_box(tile))
+        ilastik_time = time.time()
+        ilastik_maps = ilastik_session(classifier, no_of_threads, ram).classify(subvol_data)
+        ilastik_time = time.time() - ilastik_time
+        native_time = time.time()
+        native_maps = native.classify(subvol_data, no_of_threads)
+        native_time = time.time() - native_time
+        core = grid.core_in_halo(tile)
+        ilastik_maps = np.asarray(ilastik_maps, dtype='float32')[core]
+        native_maps = native_maps[core]
+        same_label = np.mean(np.argmax(ilastik_maps, axis=-1) == np.argmax(native_maps, axis=-1))
+        difference = np.abs(ilastik_maps - native_maps)
+        agreement = min(agreement, same_label)
+        print("Sub-volume %d: same label %.4f, largest probability difference %.4f, mean %.4f, "
+              "Ilastik %.1f sec, native %.1f sec" % (tile, same_label, difference.max(), difference.mean(),
+                                                     ilastik_time, native_time))
+    print("Smallest label agreement of %d sub-volumes is %.4f" % (len(sample), agreement))
+    return agreement
+
+
+if __name__ == '__main__':
+    native = NativeClassifier.from_ilp(classifier)
+    native.save(native_classifier_file)
+    print("Saved native classifier to %s" % native_classifier_file)
+    validate_native_classifier(native)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python 
+
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+Encoding of the stored probability maps, see prob_map_dtype in the seg_user_param.py file. The maps are
+computed as float32 probabilities and stored as float32, float16 or uint8 scaled to 0-255. The encoding is
+kept in the 'prob_map_dtype' attribute of a probability map dataset.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+from segmentation_param import *
+
+__author__ = "Mehdi Tondravi"
+__copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['encode_prob_map',
+           'decode_prob_map',
+           'create_prob_map_dataset',
+           'prob_map_encoding',
+           'read_prob_map']
+
+# Largest stored value of the probability one per encoding, 1.0 for the float encodings.
+_prob_map_scales = {'float32': 1.0,
+                    'float16': 1.0,
+                    'uint8': 255.0}
+
+
+def _encoding(dtype):
+    """
+    Returns the encoding name of dtype, or raises ValueError if it is not a probability map encoding.
+    """
+    encoding = str(dtype).lower()
+    if encoding not in _prob_map_scales:
+        raise ValueError("prob_map_dtype is %s, it must be one of %s" % (dtype, ', '.join(_prob_map_scales)))
+    return encoding
+
+
+def encode_prob_map(prob_map, dtype=prob_map_dtype):
+    """
+    Returns the probabilities prob_map encoded as dtype. uint8 probabilities are rounded to multiples of
+    1/255.
+    """
+    encoding = _encoding(dtype)
+    if encoding == 'uint8':
+        return np.rint(np.clip(prob_map, 0, 1) * _prob_map_scales[encoding]).astype('uint8')
+    return np.asarray(prob_map).astype(encoding, copy=False)
+
+
+def decode_prob_map(data, dtype):
+    """
+    Returns the float32 probabilities of data encoded as dtype.
+    """
+    encoding = _encoding(dtype)
+    probs = np.asarray(data).astype('float32', copy=False)
+    if _prob_map_scales[encoding] != 1.0:
+        probs = probs / np.float32(_prob_map_scales[encoding])
+    return probs
+
+
+def create_prob_map_dataset(group, name, shape, dtype=prob_map_dtype, **kwargs):
+    """
+    Creates the probability map dataset name in the HDF5 group for maps encoded as dtype and records the
+    encoding. kwargs are passed on to create_dataset().
+    """
+    encoding = _encoding(dtype)
+    dataset = group.create_dataset(name, shape, dtype=encoding, **kwargs)
+    dataset.attrs['prob_map_dtype'] = encoding
+    return dataset
+
+
+def prob_map_encoding(dataset):
+    """
+    Returns the encoding of a probability map dataset, float32 for maps written without one.
+    """
+    encoding = dataset.attrs.get('prob_map_dtype', 'float32')
+    return encoding.decode() if isinstance(encoding, bytes) else str(encoding)
+
+
+def read_prob_map(dataset, box=Ellipsis):
+    """
+    Returns the float32 probabilities of box of a probability map dataset.
+    """
+    return decode_prob_map(dataset[box], prob_map_encoding(dataset))
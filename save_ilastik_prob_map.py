@@ -59,11 +59,13 @@ import os.path
 from glob import glob
 import time
 from segmentation_param import *
+from prob_map_codec import create_prob_map_dataset, encode_prob_map
 
 __author__ = "Mehdi Tondravi"
 __copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
-__all__ = ['save_ilastik_prob_map']
+__all__ = ['save_ilastik_prob_map',
+           'ProbMapWriter']
 
 def save_ilastik_prob_map(prob_maps, orig_idx_data, rightoverlap_data, leftoverlap_data, idx, idx_list):
     """ 
@@ -76,32 +78,54 @@ def save_ilastik_prob_map(prob_maps, orig_idx_data, rightoverlap_data, leftoverl
     idx - file number
     idx_list - list of indices of object classes to save their probability map
     Ouputs:
-    a hdf5 file per sub-volume with a dataset for each defined segmented class.
+    a hdf5 file per sub-volume with a dataset for each defined segmented class, encoded as prob_map_dtype.
     """
     
     start_time = time.time()
-    ilastik_classes = get_ilastik_labels()
-    prob_map_file = hdf_subvol_files_location + '/subarr_prob_map_' + str(idx).zfill(5) + '.h5'
-    probfile = h5py.File(prob_map_file, 'w')
-    # Save sub-volume indices 
-    subvol_indx = probfile.create_dataset('orig_indices', (6,), dtype='uint64')
-    subvol_indx[...] = orig_idx_data
-    # Save sub-volume right and left side overlaps.
-    subvol_rightoverlap = probfile.create_dataset('right_overlap', (3,), dtype='uint8')
-    subvol_rightoverlap[...] = rightoverlap_data
-    subvol_leftoverlap = probfile.create_dataset('left_overlap', (3,), dtype='uint8')
-    subvol_leftoverlap[...] = leftoverlap_data
-    print("*** Create subvolume probability map for ****", idx_list)
-    write_time = time.time()
-    for label_idx in idx_list:
-        dataset = ilastik_classes[label_idx]
-        map_to_save = prob_maps[..., label_idx]
-        mapds = probfile.create_dataset(dataset, map_to_save.shape, map_to_save.dtype)
-        mapds[...] = map_to_save
-    
-    print("dataset write time for one dataset is %d Sec" % (time.time() - write_time))
-    probfile.close()
+    prob_writer = ProbMapWriter(prob_maps.shape[:-1], orig_idx_data, rightoverlap_data, leftoverlap_data, idx, idx_list)
+    prob_writer.write(0, prob_maps)
+    prob_writer.close()
     end_time = time.time()
     print("Exec time for create_segmented_subvol is %d Sec" % ((end_time - start_time)))
     return
 
+
+class ProbMapWriter(object):
+    """
+    Writes the probability map hdf5 file of a sub-volume one x-block at a time, see save_ilastik_prob_map().
+    The file and its datasets, of the given sub-volume shape, are created by the constructor, the blocks are
+    written by write() and the file is closed by close().
+    """
+    
+    def __init__(self, shape, orig_idx_data, rightoverlap_data, leftoverlap_data, idx, idx_list):
+        ilastik_classes = get_ilastik_labels()
+        self.idx_list = idx_list
+        prob_map_file = hdf_subvol_files_location + '/subarr_prob_map_' + str(idx).zfill(5) + '.h5'
+        self.probfile = h5py.File(prob_map_file, 'w')
+        # Save sub-volume indices 
+        subvol_indx = self.probfile.create_dataset('orig_indices', (6,), dtype='uint64')
+        subvol_indx[...] = orig_idx_data
+        # Save sub-volume right and left side overlaps.
+        subvol_rightoverlap = self.probfile.create_dataset('right_overlap', (3,), dtype='uint8')
+        subvol_rightoverlap[...] = rightoverlap_data
+        subvol_leftoverlap = self.probfile.create_dataset('left_overlap', (3,), dtype='uint8')
+        subvol_leftoverlap[...] = leftoverlap_data
+        print("*** Create subvolume probability map for ****", idx_list)
+        self.mapds = [create_prob_map_dataset(self.probfile, ilastik_classes[label_idx], tuple(shape))
+                      for label_idx in idx_list]
+    
+    def write(self, x_start, prob_maps):
+        """
+        Writes the probability maps of the x-block of the sub-volume starting at slice x_start.
+        """
+        write_time = time.time()
+        block = slice(x_start, x_start + prob_maps.shape[0])
+        for label_idx, mapds in zip(self.idx_list, self.mapds):
+            mapds[block] = encode_prob_map(prob_maps[..., label_idx])
+        print("dataset write time for one dataset is %d Sec" % (time.time() - write_time))
+    
+    def close(self):
+        """
+        Closes the probability map file.
+        """
+        self.probfile.close()
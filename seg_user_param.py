@@ -119,3 +119,226 @@ save_vessel_prob_map = 'yes'
 
 # whether to save segmented pixels in binary or pixel intensity.
 binary_output = 'no'
+
+'''
+HDF5 layout of the volume file created from the TIFF files.
+vol_chunk_layout - 'yes' to chunk the volume along the sub-volume grid, 'no' for a contiguous layout.
+vol_chunk_divisor - each chunk is the sub-volume size divided by this number along every axis.
+vol_compression - lossless compression of the volume: '' for none, 'gzip', 'lzf' or 'blosc'
+(blosc needs the hdf5plugin package). Setting a compression implies a chunked layout.
+vol_compression_level - gzip level (0-9) or blosc clevel (0-9), ignored by lzf.
+'''
+vol_chunk_layout = 'no'
+vol_chunk_divisor = 1
+vol_compression = ''
+vol_compression_level = 4
+
+'''
+Parallel conversion of the TIFF files - each rank converts a contiguous block of files.
+ingest_batch_slices - number of TIFF files read into one buffer and written with a single call. On a
+chunked volume it is rounded up to a multiple of the chunk depth.
+ingest_collective_io - 'yes' to write with collective MPI-IO. Compressed volumes are always written collectively.
+'''
+ingest_batch_slices = 16
+ingest_collective_io = 'no'
+
+'''
+Decoding of the TIFF files, overlapped with the HDF5 writes of a rank.
+ingest_decode_threads - number of threads of a rank decoding TIFF files, 0 to decode in the writing thread.
+ingest_queue_depth - maximum number of decoded TIFF files a rank holds in memory ahead of its writes.
+ingest_tiff_memmap - 'yes' to read uncompressed TIFF files through a memory map instead of the decoder.
+'''
+ingest_decode_threads = 2
+ingest_queue_depth = 8
+ingest_tiff_memmap = 'no'
+
+'''
+Resumable conversion of the TIFF files. A manifest of the converted TIFF files is kept next to the volume file.
+ingest_resume - 'yes' to convert only new or changed TIFF files into the volume file of a previous run,
+'no' to always convert all TIFF files into a new volume file.
+ingest_checksum - '' to detect changed TIFF files by size and modification time only, or a hashlib
+algorithm name, e.g. 'md5', to also compare file checksums.
+'''
+ingest_resume = 'yes'
+ingest_checksum = ''
+
+'''
+Volume image backend used by the sub-volume and classification stages.
+'hdf5' - the TIFF files are converted into a HDF5 volume file by tiff_to_hdf5_mpi.py.
+'external' - tiff_to_hdf5_mpi.py creates a HDF5 volume file whose storage is the image data of the TIFF
+files, no data is copied. Requires uncompressed TIFF files, otherwise the TIFF files are converted.
+'tiff' - the TIFF files are read directly, tiff_to_hdf5_mpi.py does nothing.
+tiff_cache_mb - megabytes of decoded compressed TIFF images kept in memory by the 'tiff' backend.
+'''
+volume_backend = 'hdf5'
+tiff_cache_mb = 1024
+
+'''
+Volume statistics computed while converting the TIFF files. Per slice histograms, min, max, mean and
+foreground voxel fractions are stored in the 'stats' group of the volume file, whole volume min, max, mean
+and foreground fraction are stored as attributes of the volume dataset.
+ingest_stats - 'yes' to compute the statistics.
+ingest_hist_bins - number of bins of the per slice intensity histograms.
+background_threshold - voxels with intensity above this value are foreground.
+'''
+ingest_stats = 'yes'
+ingest_hist_bins = 256
+background_threshold = 0
+
+'''
+Bit depth reduction of the volume while converting the TIFF files.
+ingest_output_dtype - '' to keep the type of the TIFF files, 'uint8' or 'uint16' to requantize the volume.
+ingest_clip_percentiles - the intensities at these low and high percentiles of the whole volume are mapped
+to the lowest and highest value of ingest_output_dtype, intensities outside are clipped.
+ingest_requant_bins - number of bins of the histogram pass used to find the percentiles.
+'''
+ingest_output_dtype = ''
+ingest_clip_percentiles = (0.1, 99.9)
+ingest_requant_bins = 65536
+
+'''
+Multiresolution pyramid of the volume built while converting the TIFF files, for previewing and picking
+regions of interest. Each level is the block mean of the volume over factor x factor x factor voxels and
+is stored as dataset 'pyramid/<factor>x' of the volume file.
+ingest_pyramid_factors - downsampling factors of the levels, e.g. (2, 4, 8), or () for no pyramid.
+'''
+ingest_pyramid_factors = ()
+
+'''
+How the classification stage gets the sub-volume images.
+'files' - make_subvolume_mpi.py copies each sub-volume, with its overlap, into its own HDF5 file.
+'direct' - make_subvolume_mpi.py only writes an index of the sub-volumes and segment_subvols_pixels.py reads
+each sub-volume from the volume, see volume_backend, which saves writing and reading a copy of the volume.
+'''
+subvol_mode = 'files'
+
+'''
+How make_subvolume_mpi.py reads the volume when subvol_mode is 'files'.
+subvol_read_mode - 'tile' to read each sub-volume from the volume on its own, 'slab' to read the halo padded
+x-slab of a row of sub-volumes once and cut all its sub-volumes from memory. Slabs are given to ranks
+instead of sub-volumes.
+subvol_slab_mb - most megabytes of a slab read at once, larger slabs are read in bands along y.
+'''
+subvol_read_mode = 'tile'
+subvol_slab_mb = 4096
+
+'''
+Automatic sub-volume dimensions, see tile_planner.py.
+auto_tile_size - 'yes' to pick the largest sub-volume dimensions whose classification fits into the memory
+of a rank, il_sub_vol_x, il_sub_vol_y and il_sub_vol_z are then not used. 'no' to use them.
+tile_memory_factor - memory of Ilastik per float32 feature and probability value of a voxel, raise it if
+classification runs out of memory.
+ranks_per_node - number of classification ranks running on a server, the memory of a server is divided
+among them. Leave it blank to use the number of ranks of make_subvolume_mpi.py on a server.
+'''
+auto_tile_size = 'no'
+tile_memory_factor = 1.5
+ranks_per_node = ''
+
+'''
+Background sub-volumes are not classified, their outputs are zero and are not written.
+skip_background_tiles - 'yes' to find the background sub-volumes in make_subvolume_mpi.py.
+A sub-volume, with its overlap, is background when no voxel is above background_threshold or, if
+background_max_std is not blank, when the standard deviation of its intensities is at most background_max_std.
+'''
+skip_background_tiles = 'no'
+background_max_std = ''
+
+'''
+Sub-volume overlap in pixels. Leave it blank to derive it from the largest feature scale selected in the
+Ilastik project, the smallest overlap without seams between sub-volumes. Overlaps above 255 are not supported.
+'''
+pixel_overlap = ''
+
+'''
+Order and division of the sub-volumes among the ranks in every stage, see TileGrid.rank_tiles() in tile_grid.py.
+tile_traversal - 'xyz' (sub-volume number order), 'zyx', 'snake', 'morton' or 'hilbert'. The snake, Morton
+and Hilbert orders go from a sub-volume to a neighbour.
+tile_assignment - 'cyclic' hands the sub-volumes out to the ranks in turn, 'block' gives each rank a run of
+consecutive sub-volumes so that a rank works on a compact part of the volume.
+'''
+tile_traversal = 'xyz'
+tile_assignment = 'cyclic'
+
+'''
+Scheduling of the sub-volume classification in segment_subvols_pixels.py, see tile_scheduler.py.
+tile_scheduling - 'static' gives each rank its sub-volumes up front (see tile_assignment), 'dynamic' keeps the
+sub-volumes in a queue shared by all ranks and a rank takes the next one when it is done with its sub-volume.
+tile_cost_order - 'yes' to order the dynamic queue by estimated cost, largest first. The cost is the size of a
+sub-volume weighted by its foreground fraction from the volume pyramid (see ingest_pyramid_factors).
+'''
+tile_scheduling = 'static'
+tile_cost_order = 'no'
+
+'''
+Pipelined classification in segment_subvols_pixels.py.
+segment_pipeline - 'yes' to read the next sub-volume in a reader thread and write the outputs of the previous
+sub-volume in a writer thread while Ilastik classifies the current one.
+segment_queue_depth - sub-volumes read ahead, and sub-volumes waiting to be written, at most. Each holds its
+image, masks and probability maps in memory next to the sub-volume being classified.
+'''
+segment_pipeline = 'no'
+segment_queue_depth = 1
+
+'''
+Resumable classification in segment_subvols_pixels.py. A completion marker is written next to the segmented
+files of each finished sub-volume.
+segment_resume - 'yes' to keep the sub-volumes finished by a previous run with the same sub-volume grid,
+volume file, classifier and outputs, and classify only the others. 'no' removes the outputs of previous runs.
+'''
+segment_resume = 'no'
+
+'''
+Executor of the pipeline stages, see executor.py.
+executor_backend - 'mpi' to run a stage on the MPI ranks it is started with (mpirun), 'local' to run it as a
+single process with a pool of worker processes on this computer, without MPI or Parallel HDF. With 'local'
+only the driver process writes to the volume files.
+local_processes - number of worker processes of the 'local' backend, blank for one per core.
+'''
+executor_backend = 'mpi'
+local_processes = ''
+
+'''
+Pixel classifier of segment_subvols_pixels.py, see native_classifier.py.
+pixel_classifier - 'ilastik' to classify the sub-volumes with Ilastik, 'native' to compute the features selected
+in the Ilastik project with scipy filters and run its trained random forests with numpy, without loading
+Ilastik. Run "python native_classifier.py" to export the classifier of the project and compare the native
+probability maps with the ones of Ilastik on native_validate_tiles sub-volumes before using 'native'.
+native_batch_voxels - voxels classified at once by the native random forests.
+'''
+pixel_classifier = 'ilastik'
+native_validate_tiles = 4
+native_batch_voxels = 65536
+
+'''
+Storage of the probability maps saved with save_cell_prob_map and save_vessel_prob_map, see prob_map_codec.py.
+prob_map_dtype - 'float32' as computed by the classifier, 'float16' for half the size, or 'uint8' for a quarter
+of the size with the probabilities scaled to 0-255. It applies to the sub-volume maps and the combined volume
+maps. read_prob_map() in prob_map_codec.py returns the float32 probabilities of a stored map.
+'''
+prob_map_dtype = 'float32'
+
+'''
+Streaming classification in segment_subvols_pixels.py.
+segment_block_x - blank to classify a sub-volume at once, or the number of x slices classified at a time. The
+outputs of a block are written before the next block is classified, so the probability maps and masks in
+memory are the ones of a block with the overlap on each side, not of the whole sub-volume. The sub-volume image
+is read whole. Each block is classified with the overlap on both sides, blocks much thicker than the overlap
+classify fewer voxels twice.
+'''
+segment_block_x = ''
+
+'''
+Tuning of the classification resources of a server, see autotune.py. "python autotune.py" classifies
+autotune_tiles sub-volumes under each configuration of ranks per server, Ilastik threads per rank and share of
+the server memory, and writes the configuration with the most voxels classified per second on the server.
+autotune_ranks - ranks per server to try, e.g. (1, 2, 4), blank for the powers of two up to the CPUs.
+autotune_threads - Ilastik threads per rank to try, e.g. (2, 4), blank for the CPUs divided among the ranks.
+autotune_mem_percents - percents of the server memory to try, e.g. (50, 80), blank for percent_mem_to_use.
+autotune_pin_cpus - 'yes' to pin each rank to its own CPUs.
+'''
+autotune_tiles = 2
+autotune_ranks = ''
+autotune_threads = ''
+autotune_mem_percents = ''
+autotune_pin_cpus = 'no'
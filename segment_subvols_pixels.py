@@ -53,16 +53,25 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import os.path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
+import json
 import h5py
 import numpy as np
 from glob import glob
-from mpi4py import MPI
+from executor import MPI, get_executor
 import time
 from segmentation_param import *
 from classify_pixel import classify_pixel
 from create_subvol_mask import create_subvol_mask
-from create_segmented_subvol import create_segmented_subvol
-from save_ilastik_prob_map import save_ilastik_prob_map
+from create_segmented_subvol import create_segmented_subvol, SegmentedSubvolWriter
+from save_ilastik_prob_map import save_ilastik_prob_map, ProbMapWriter
+from tile_grid import TileGrid
+from tile_planner import bytes_per_voxel, feature_reach, rank_memory_mb, tile_memory_mb
+from tile_scheduler import TileScheduler
+from volume_backend import open_volume, process_volume, read_volume_box
 import pdb
 
 __author__ = "Mehdi Tondravi"
@@ -73,7 +82,8 @@ __all__ = ['segment_subvols_pixels']
 def segment_subvols_pixels():
     """
     Divides many *.hdf5 sub-volume image files among ranks created for classification
-    and segmentation. A rank uses Ilastik classifier to create probability maps, and then
+    and segmentation. The sub-volumes are the tiles of the grid in tile_grid_file. When subvol_mode
+    is 'direct' the sub-volumes are read from the volume instead. A rank uses Ilastik classifier to create probability maps, and then
     separate the input image into as many as images as are defined labels in the training data.
     
     Inputs: 
@@ -85,9 +95,10 @@ def segment_subvols_pixels():
     Saves cell probability map if the user has requested it by setting "save_cell_prob_map" to "yes".
     
     """
-    comm = MPI.COMM_WORLD
+    executor = get_executor()
+    comm = executor.comm
     rank = comm.Get_rank()
-    size = MPI.COMM_WORLD.Get_size()
+    size = comm.Get_size()
     name = MPI.Get_processor_name()
     start_time = int(time.time())
     # Determine how many threads to be used by an Ilastik python process.
@@ -96,38 +107,80 @@ def segment_subvols_pixels():
         threads = no_of_threads
     else:
         threads = int(no_of_threads_to_use)
-    # Determine how much memory to be used by an Ilastik python process.
-    if not percent_mem_to_use:
-        # Use all available memory
-        ram = int(ram_size)
-    else:
-        ram = int(ram_size * (int(percent_mem_to_use)/100.0))
-    
-    # if not enough memory stop processing. Required memory is subvolume size times 4 bytes times
-    # number of labeled classed plus two.
-    mem_required = il_sub_vol_x * il_sub_vol_y * il_sub_vol_z * (len(get_ilastik_labels()) + 2) * 4
-    if int(mem_required / 1e6) > ram:
-        print("AVAILABLE MEMORY IS NOT BIG ENOUGH TO PROCEED. MAKE SUBVOLUME SMALLER AND TRY AGAIN")
-        print("Avaiable memory is %d MB and required memory is %d MB" % (ram, int(mem_required/ 1e6)))
+    # The threads of a rank are shared by the worker processes of the local executor.
+    threads = max(threads // executor.processes, 1)
+    # The sub-volumes are the tiles of the grid written by make_subvolume_mpi.py.
+    if not os.path.exists(tile_grid_file):
+        print("*** Did not find the sub-volume grid file %s ***" % tile_grid_file)
         return
+    grid = TileGrid.load(tile_grid_file)
+    # Determine how much memory to be used by an Ilastik python process, the memory of a server is
+    # shared by its ranks and their worker processes.
+    ram = rank_memory_mb(comm) // executor.processes
+    # Warn if the largest sub-volume may not fit, see tile_planner.py for the memory estimate. A sub-volume
+    # classified in x-blocks needs the memory of a block with its overlap, see segment_block_x.
+    # The classifier is read once for the slices an x-block is classified with, see _block_halo().
+    block_halo = _block_halo(grid) if segment_block_x else None
+    halo_shapes = grid.stop + grid.right - grid.start + grid.left
+    if segment_block_x:
+        halo_shapes[:, 0] = np.minimum(halo_shapes[:, 0], max(int(segment_block_x), 1) + 2 * block_halo)
+    mem_required = tile_memory_mb(halo_shapes[np.argmax(np.prod(halo_shapes, axis=1))], bytes_per_voxel())
+    if mem_required > ram and rank == 0:
+        print("AVAILABLE MEMORY MAY NOT BE BIG ENOUGH, MAKE SUBVOLUME SMALLER OR SET auto_tile_size TO 'yes'")
+        print("Avaiable memory is %d MB and required memory is %d MB" % (ram, mem_required))
     if rank == 0:
         print("*** size is %d, No of thread is %d, ram size is %d" % (size, threads, ram))
-    # assumes sub-volume image file extension is .hdf5
-    input_files = sorted(glob(hdf_subvol_files_location + '/*.hdf5'))
-    if not input_files:
-        print("*** Did not find any file ending with .hdf5 extension  ***")
-        return
+    # Background sub-volumes are not classified, their outputs are zero.
+    tiles = grid.foreground_tiles()
+    if rank == 0 and len(tiles) < len(grid):
+        print("*** Skipping %d background sub-volumes ***" % (len(grid) - len(tiles)))
+    vol_file = None
+    vol_dataset = None
+    if subvol_mode.upper() == 'DIRECT':
+        vol_file, vol_dataset = open_volume(comm)
+        if vol_dataset is None:
+            return
     if rank == 0:
-        print("Number of input/HDF5 files is %d, and Number of processes is %d" % ((len(input_files)), size))
+        print("Number of sub-volumes is %d, and Number of processes is %d" % (len(tiles), size))
     
+    # output type - binary or pixel intensity?
+    seg_output = seg_pixel_value()
+    save_prob_map_idx = []
+    # Save cell probability map in a file if user has asked for it.
+    savemap, label_index = save_prob_map('CELL')
+    if savemap == True:
+        # Save probability map
+        save_prob_map_idx.append(label_index)
+        labeld_obj = get_ilastik_labels()
+        print("Saving probability map for object type %s, rank is %d" % (labeld_obj[label_index], rank))
+    # Save vessel probability map in a file if user has asked for it.
+    savemap, label_index = save_prob_map('VESSEL')
+    if savemap == True:
+        # Save probability map
+        save_prob_map_idx.append(label_index)
+        labeld_obj = get_ilastik_labels()
+        print("Saving probability map for object type %s, rank is %d" % (labeld_obj[label_index], rank))
+    
+    # Finished sub-volumes of a previous run with the same grid, volume and classifier are kept when
+    # segment_resume is 'yes', see _finished_tiles().
+    run_key = _run_key(grid, seg_output, save_prob_map_idx)
+    finished = []
     if rank == 0:
         print("Sub-Volume file location is %s" % outimage_file_location)
+        if segment_resume.upper() == 'YES':
+            finished = _finished_tiles(tiles, run_key, save_prob_map_idx)
+            print("*** Resuming, %d of %d sub-volumes are finished ***" % (len(finished), len(tiles)))
+        keep_files = set()
+        for subvol in finished:
+            keep_files.add(_tile_marker(subvol))
+            keep_files.update(_output_files(subvol, save_prob_map_idx))
         # Remove segmented sub-volume files from previous run
         if os.path.exists(outimage_file_location):
-            subvolfiles = glob(outimage_file_location + '/subvol*.h5')
+            subvolfiles = glob(outimage_file_location + '/subvol*.h5') + glob(outimage_file_location + '/subvol*.done')
             for subfile in subvolfiles:
-                print("*** Removing segmented subvolume file ***", subfile)
-                os.remove(subfile)
+                if subfile not in keep_files:
+                    print("*** Removing segmented subvolume file ***", subfile)
+                    os.remove(subfile)
         # Create the directory for segmented sub-volume images if it does not exist. 
         if not os.path.exists(outimage_file_location):
             print("*** Creating directory %s ***" % outimage_file_location)
@@ -135,75 +188,294 @@ def segment_subvols_pixels():
         # Remove sub-volume cell & vessel probability map from previous run
         subvol_probmap_files = glob(hdf_subvol_files_location + '/subarr_prob_map_*.h5')
         for prob_map_file in subvol_probmap_files:
-            print("**** Removing old subvolume probability map files ****", prob_map_file)
-            os.remove(prob_map_file)
+            if prob_map_file not in keep_files:
+                print("**** Removing old subvolume probability map files ****", prob_map_file)
+                os.remove(prob_map_file)
+    finished = comm.bcast(finished, root=0)
+    tiles = tiles[~np.isin(tiles, finished)]
     
     comm.Barrier()
     
     if rank == 0:
-        print("Number of input/HDF5 files is %d, and Number of processes is %d" % ((len(input_files)), size))
+        print("Number of sub-volumes is %d, and Number of processes is %d" % (len(tiles), size))
     
-    # Figure out how many sub-volume files each rank should handle.
-    iterations = int(len(input_files) / size) + (len(input_files) % size > 0)
-    # Divide pixel classification of sub-volume files among processes/ranks. 
-    for idx in range(iterations):
-        if (rank + (size * idx)) >= len(input_files):
-            print("\nBREAKING out, this rank is done with its processing, my rank is %d, number of files is %d, size is %d and idx is %d" %
-                  (rank, len(input_files), size, idx))
-            break
-        start_loop_time = time.time()
-        filename = input_files[(rank + size * idx)]
-        dsname, ext = os.path.splitext(os.path.basename(filename))
-        hdf_filename = h5py.File(filename, 'r')
-        subvol_ds = hdf_filename[dsname]
-        # Retrieve the indices into whole volume for this sub-volume.
-        orig_idx_ds = hdf_filename['orig_indices']
-        orig_idx_data = orig_idx_ds[...]
-        # Retrive overlap size to the right side of the sub-volume. 
-        rightoverlap_ds = hdf_filename['right_overlap']
-        rightoverlap_data = rightoverlap_ds[...]
-        # Retrive overlap size to the left side of the sub-volume.
-        leftoverlap_ds = hdf_filename['left_overlap']
-        leftoverlap_data = leftoverlap_ds[...]
-        
-        start_dstime = time.time()
-        subvol_data = subvol_ds[...]
-        print("Read time for datasetfrom disk is %d sec and rank is %d" % ((time.time() - start_dstime), rank))
-        ilastik_time = time.time()
-        probability_maps = classify_pixel(subvol_data, classifier, threads, ram)
-        print("probability_map shape and data type are", probability_maps.shape, probability_maps.dtype)
-        print("time for ilastik classification is %d sec and rank is %d" % ((time.time() - ilastik_time), rank))
-        
-        mask_time = time.time()
-        subvol_pixel_masks = create_subvol_mask(probability_maps)
-        print("time to create pixel masks is %d sec and rank is %d" % ((time.time() - mask_time), rank))
-        
-        segment_time = time.time()
-        # output type - binary or pixel intensity?
-        seg_output = seg_pixel_value()
-        create_segmented_subvol(subvol_data, subvol_pixel_masks, dsname, orig_idx_data, rightoverlap_data, leftoverlap_data, seg_output)
-        save_prob_map_idx = []
-        # Save cell probability map in a file if user has asked for it.
-        savemap, label_index = save_prob_map('CELL')
-        if savemap == True:
-            # Save probability map
-            save_prob_map_idx.append(label_index)
-            labeld_obj = get_ilastik_labels()
-            print("Saving probability map for object type %s, rank is %d" % (labeld_obj[label_index], rank))
-        # Save vessel probability map in a file if user has asked for it.
-        savemap, label_index = save_prob_map('VESSEL')
-        if savemap == True:
-            # Save probability map
-            save_prob_map_idx.append(label_index)
-            labeld_obj = get_ilastik_labels()
-            print("Saving probability map for object type %s, rank is %d" % (labeld_obj[label_index], rank))
-        if save_prob_map_idx:
-            save_ilastik_prob_map(probability_maps, orig_idx_data, rightoverlap_data, leftoverlap_data, idx, save_prob_map_idx)
-        print("time to time to segement pixels is %d sec and rank is %d" % ((time.time() - segment_time), rank))
+    # Divide pixel classification of sub-volume files among processes/ranks, see tile_scheduling.
+    scheduler = TileScheduler(grid, tiles, comm)
+    if executor.backend == 'local':
+        # Each worker process of the local executor reads, classifies and writes whole sub-volumes.
+        for subvol in executor.imap(_segment_subvol, scheduler, grid, threads, ram, seg_output, save_prob_map_idx, run_key,
+                                    block_halo):
+            print("Done with sub-volume %d" % subvol)
+    else:
+        _segment_rank_subvols(scheduler, grid, vol_file, vol_dataset, threads, ram, seg_output, save_prob_map_idx, run_key,
+                              block_halo)
     
+    scheduler.close()
+    executor.close()
+    if vol_file is not None:
+        vol_file.close()
     end_time = int(time.time())
     exec_time = end_time - start_time
     print("*** My Rank is %d, exec time is %d sec - Done with classifying pixels in sub-volume files ***" % (rank, exec_time))
 
+
+def _segment_rank_subvols(scheduler, grid, vol_file, vol_dataset, threads, ram, seg_output, save_prob_map_idx, run_key,
+                          block_halo):
+    """
+    Classifies and segments the sub-volumes of an MPI rank.
+    In the pipelined mode the next sub-volume is read by a reader thread and the outputs of the previous
+    sub-volume are written by a writer thread while Ilastik classifies the current one. MPI is only called
+    by this thread, a volume read with Parallel HDF stays in this thread unless MPI allows calls from any
+    thread.
+    """
+    pipelined = segment_pipeline.upper() == 'YES'
+    queue_depth = max(int(segment_queue_depth), 1)
+    read_in_thread = pipelined and (vol_file is None or vol_file.driver != 'mpio' or
+                                    MPI.Query_thread() == MPI.THREAD_MULTIPLE)
+    if scheduler.rank == 0:
+        print("Pipelined is %s, reads in reader thread is %s, queue depth is %d" % (pipelined, read_in_thread, queue_depth))
+    read_subvol = functools.partial(_read_subvol, grid=grid, vol_dataset=vol_dataset)
+    pending_writes = deque()
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+        for subvol, subvol_data in _read_ahead(read_subvol, scheduler, reader if read_in_thread else None, queue_depth):
+            if segment_block_x:
+                _stream_subvol(grid, subvol, subvol_data, threads, ram, seg_output, save_prob_map_idx, run_key,
+                               block_halo, writer if pipelined else None)
+                continue
+            probability_maps, subvol_pixel_masks = _classify_subvol(subvol_data, threads, ram)
+            write_args = (grid, subvol, subvol_data, subvol_pixel_masks, probability_maps, seg_output, save_prob_map_idx, run_key)
+            if not pipelined:
+                _write_subvol_outputs(*write_args)
+                continue
+            pending_writes.append(writer.submit(_write_subvol_outputs, *write_args))
+            # At most queue_depth sub-volumes wait to be written.
+            while len(pending_writes) > queue_depth:
+                pending_writes.popleft().result()
+        while pending_writes:
+            pending_writes.popleft().result()
+
+
+def _read_ahead(read_subvol, tiles, reader, queue_depth):
+    """
+    Yields (sub-volume, image) for the tiles. If reader is a thread pool the images are read by it, at most
+    queue_depth sub-volumes ahead of the consumer, otherwise they are read when they are needed. The tiles
+    are taken in the consumer's thread.
+    """
+    if reader is None:
+        for subvol in tiles:
+            yield subvol, read_subvol(subvol)
+        return
+    tile_iter = iter(tiles)
+    pending = deque()
+    for subvol in itertools.islice(tile_iter, queue_depth):
+        pending.append((subvol, reader.submit(read_subvol, subvol)))
+    while pending:
+        subvol, future = pending.popleft()
+        subvol_data = future.result()
+        for next_subvol in itertools.islice(tile_iter, 1):
+            pending.append((next_subvol, reader.submit(read_subvol, next_subvol)))
+        yield subvol, subvol_data
+
+
+def _segment_subvol(subvol, grid, threads, ram, seg_output, save_prob_map_idx, run_key, block_halo):
+    """
+    Reads, classifies and segments a sub-volume and writes its outputs, in a worker process of the local
+    executor. Returns the sub-volume.
+    """
+    subvol_data = _read_subvol(subvol, grid, None)
+    if segment_block_x:
+        _stream_subvol(grid, subvol, subvol_data, threads, ram, seg_output, save_prob_map_idx, run_key, block_halo)
+        return subvol
+    probability_maps, subvol_pixel_masks = _classify_subvol(subvol_data, threads, ram)
+    _write_subvol_outputs(grid, subvol, subvol_data, subvol_pixel_masks, probability_maps, seg_output, save_prob_map_idx, run_key)
+    return subvol
+
+
+def _stream_subvol(grid, subvol, subvol_data, threads, ram, seg_output, save_prob_map_idx, run_key, block_halo,
+                   writer=None):
+    """
+    Classifies and segments a sub-volume in x-blocks of segment_block_x slices. The outputs of a block are
+    written before the next block is classified, so only the probability maps and masks of one block are
+    in memory. A block is classified with up to block_halo slices of the sub-volume image on each side, so
+    the outputs of the core of the sub-volume are the ones of the whole sub-volume. If writer is a thread
+    pool a block is written by it while the next block is classified. The completion marker is written
+    after the last block.
+    """
+    segment_time = time.time()
+    orig_idx_data = grid.orig_indices(subvol)
+    rightoverlap_data = grid.right[subvol]
+    leftoverlap_data = grid.left[subvol]
+    seg_writer = SegmentedSubvolWriter(subvol_data.shape, subvol_data.dtype, subvol_name(subvol), orig_idx_data,
+                                       rightoverlap_data, leftoverlap_data, seg_output)
+    prob_writer = None
+    if save_prob_map_idx:
+        prob_writer = ProbMapWriter(subvol_data.shape, orig_idx_data, rightoverlap_data, leftoverlap_data, subvol,
+                                    save_prob_map_idx)
+    block_x = max(int(segment_block_x), 1)
+    pending_write = None
+    for x_start in range(0, subvol_data.shape[0], block_x):
+        x_stop = min(x_start + block_x, subvol_data.shape[0])
+        context_start = max(x_start - block_halo, 0)
+        context_stop = min(x_stop + block_halo, subvol_data.shape[0])
+        probability_maps, subvol_pixel_masks = _classify_subvol(subvol_data[context_start:context_stop], threads, ram,
+                                                                slice(x_start - context_start, x_stop - context_start))
+        write_args = (seg_writer, prob_writer, x_start, subvol_data[x_start:x_stop], subvol_pixel_masks, probability_maps)
+        # At most one block waits to be written.
+        if pending_write is not None:
+            pending_write.result()
+        if writer is None:
+            _write_subvol_block(*write_args)
+        else:
+            pending_write = writer.submit(_write_subvol_block, *write_args)
+        del probability_maps, subvol_pixel_masks, write_args
+    if pending_write is not None:
+        pending_write.result()
+    seg_writer.close()
+    if prob_writer is not None:
+        prob_writer.close()
+    _write_tile_marker(subvol, run_key, save_prob_map_idx)
+    print("time to classify and segment %d x-blocks is %d sec, sub-volume is %d" %
+          (-(-subvol_data.shape[0] // block_x), (time.time() - segment_time), subvol))
+
+
+def _block_halo(grid):
+    """
+    Returns the slices an x-block of a sub-volume is classified with on each side: the reach of the features
+    of the classifier, whatever the grid overlap, or the grid overlap if the project has no feature scales.
+    """
+    reach = feature_reach(classifier)
+    return grid.overlap if reach is None else reach
+
+
+def _write_subvol_block(seg_writer, prob_writer, x_start, subvol_data, subvol_pixel_masks, probability_maps):
+    """
+    Writes the segmented images and the probability maps of the x-block of a sub-volume starting at x_start.
+    """
+    seg_writer.write(x_start, subvol_data, subvol_pixel_masks)
+    if prob_writer is not None:
+        prob_writer.write(x_start, probability_maps)
+
+
+def _classify_subvol(subvol_data, threads, ram, core=Ellipsis):
+    """
+    Returns the Ilastik probability maps and the pixel masks of a sub-volume, of its x slices core if given.
+    """
+    ilastik_time = time.time()
+    probability_maps = classify_pixel(subvol_data, classifier, threads, ram)[core]
+    print("probability_map shape and data type are", probability_maps.shape, probability_maps.dtype)
+    print("time for ilastik classification is %d sec" % (time.time() - ilastik_time))
+    
+    mask_time = time.time()
+    subvol_pixel_masks = create_subvol_mask(probability_maps)
+    print("time to create pixel masks is %d sec" % (time.time() - mask_time))
+    return probability_maps, subvol_pixel_masks
+
+
+def _read_subvol(subvol, grid, vol_dataset):
+    """
+    Returns the image of a sub-volume, read from its sub-volume file or from the volume when subvol_mode is
+    'direct'. The volume is opened by this process if vol_dataset is None.
+    """
+    start_dstime = time.time()
+    if subvol_mode.upper() == 'DIRECT':
+        if vol_dataset is None:
+            vol_dataset = process_volume()
+        subvol_data = read_volume_box(vol_dataset, *grid.halo_box(subvol))
+    else:
+        dsname = subvol_name(subvol)
+        hdf_filename = h5py.File(hdf_subvol_files_location + '/' + dsname + '.hdf5', 'r')
+        subvol_data = hdf_filename[dsname][...]
+        hdf_filename.close()
+    print("Read time for datasetfrom disk is %d sec, sub-volume is %d" % ((time.time() - start_dstime), subvol))
+    return subvol_data
+
+
+def _write_subvol_outputs(grid, subvol, subvol_data, subvol_pixel_masks, probability_maps, seg_output, save_prob_map_idx, run_key):
+    """
+    Writes the segmented sub-volume file and, for the labels in save_prob_map_idx, the probability map file
+    of a sub-volume, then its completion marker.
+    """
+    segment_time = time.time()
+    orig_idx_data = grid.orig_indices(subvol)
+    rightoverlap_data = grid.right[subvol]
+    leftoverlap_data = grid.left[subvol]
+    create_segmented_subvol(subvol_data, subvol_pixel_masks, subvol_name(subvol), orig_idx_data, rightoverlap_data, leftoverlap_data, seg_output)
+    if save_prob_map_idx:
+        save_ilastik_prob_map(probability_maps, orig_idx_data, rightoverlap_data, leftoverlap_data, subvol, save_prob_map_idx)
+    _write_tile_marker(subvol, run_key, save_prob_map_idx)
+    print("time to time to segement pixels is %d sec, sub-volume is %d" % ((time.time() - segment_time), subvol))
+
+
+def _run_key(grid, seg_output, save_prob_map_idx):
+    """
+    Returns what the outputs of a sub-volume depend on: the grid, the volume file, the classifier and the
+    output settings.
+    """
+    run_key = {'grid': grid.digest(), 'classifier': os.path.abspath(classifier),
+               'classifier_mtime': os.path.getmtime(classifier), 'pixel_classifier': pixel_classifier.lower(),
+               'seg_output': bool(seg_output), 'prob_maps': [int(label_idx) for label_idx in save_prob_map_idx],
+               'prob_map_dtype': prob_map_dtype.lower()}
+    hdf5_vol_file = sorted(glob(hdf_files_location + '/*.hdf5'))
+    if volume_backend.lower() != 'tiff' and hdf5_vol_file:
+        stat = os.stat(hdf5_vol_file[0])
+        run_key['volume'] = [os.path.abspath(hdf5_vol_file[0]), stat.st_size, stat.st_mtime]
+    return run_key
+
+
+def _output_files(subvol, save_prob_map_idx):
+    """
+    Returns the names of the output files of a sub-volume.
+    """
+    output_files = [outimage_file_location + '/subvol_' + subvol_name(subvol) + '.h5']
+    if save_prob_map_idx:
+        output_files.append(hdf_subvol_files_location + '/subarr_prob_map_' + str(subvol).zfill(5) + '.h5')
+    return output_files
+
+
+def _tile_marker(subvol):
+    """
+    Returns the name of the completion marker of a sub-volume.
+    """
+    return outimage_file_location + '/subvol_' + subvol_name(subvol) + '.done'
+
+
+def _write_tile_marker(subvol, run_key, save_prob_map_idx):
+    """
+    Atomically writes the completion marker of a sub-volume whose output files are written and closed. The
+    marker holds the run key and the size of each output file.
+    """
+    marker_file = _tile_marker(subvol)
+    marker = {'subvol': int(subvol), 'run': run_key,
+              'outputs': dict((output_file, os.path.getsize(output_file))
+                              for output_file in _output_files(subvol, save_prob_map_idx))}
+    with open(marker_file + '.tmp', 'w') as mfile:
+        json.dump(marker, mfile)
+        mfile.flush()
+        os.fsync(mfile.fileno())
+    os.rename(marker_file + '.tmp', marker_file)
+
+
+def _finished_tiles(tiles, run_key, save_prob_map_idx):
+    """
+    Returns the tiles finished by a previous run: the tiles with a completion marker of the same run key
+    whose output files are there with the sizes recorded in the marker.
+    """
+    finished = []
+    for subvol in tiles:
+        try:
+            with open(_tile_marker(subvol)) as mfile:
+                marker = json.load(mfile)
+        except (IOError, OSError, ValueError):
+            continue
+        if marker.get('run') != run_key:
+            continue
+        output_files = _output_files(subvol, save_prob_map_idx)
+        if sorted(marker.get('outputs', {})) != sorted(output_files):
+            continue
+        if all(os.path.exists(output_file) and os.path.getsize(output_file) == marker['outputs'][output_file]
+               for output_file in output_files):
+            finished.append(int(subvol))
+    return finished
+
 if __name__ == '__main__':
     segment_subvols_pixels()
@@ -52,7 +52,9 @@ This file has various parameters values needed for segmentation of big data.
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import math
 import multiprocessing
+import os.path
 from psutil import virtual_memory
 from seg_user_param import *
 
@@ -64,7 +66,8 @@ __docformat__ = 'restructuredtext en'
 The below parameters should not be changed.
 '''
 
-# Number of pixel to use for overlapping in sub-voluming images.
+# Number of pixel to use for overlapping in sub-voluming images when it can not be derived from the
+# feature scales of the Ilastik project, see tile_planner.classifier_halo().
 pixeloverlap = 20
 
 # Volume raw input data
@@ -73,6 +76,12 @@ hdf_files_location = tiff_files_location + '_mpi_hdf'
 # Ilastik sub-volume input/oputput hdf5 files
 hdf_subvol_files_location = tiff_files_location + '_ilastik_inout'
 
+# Grid of the sub-volumes, see tile_grid.py, written by make_subvolume_mpi.py and read by the later stages.
+tile_grid_file = hdf_subvol_files_location + '/tile_grid.h5'
+
+# Best classification configuration found by autotune.py.
+autotune_file = hdf_subvol_files_location + '/autotune.json'
+
 # Segmented pixel Sub-volume directory - contains an hdf5 file for each sub-volume.
 outimage_file_location = tiff_files_location + '_pixels_maps'
 
@@ -90,6 +99,9 @@ ram_size = int(virtual_memory().total/(1024**3)) * 1000
 
 ilp_file_name = classifier
 
+# Classifier of the Ilastik project exported for the native classifier, see native_classifier.py.
+native_classifier_file = os.path.splitext(ilp_file_name)[0] + '_native.h5'
+
 # small size objects to be removed from cell segmentation
 MINSZ_CELL = 100
 
@@ -146,3 +158,49 @@ def seg_pixel_value():
         save_binary = False
     return save_binary
 
+def subvol_name(tile):
+    '''
+    Returns the name of the sub-volume file and dataset of a tile, the TIFF directory name and the tile number.
+    '''
+    return os.path.basename(tiff_files_location) + str(tile).zfill(5)
+
+def background_tile(subvol_data):
+    '''
+    Returns whether a sub-volume image is background, it has no voxel above background_threshold or, if
+    background_max_std is set, its intensity standard deviation is at most background_max_std.
+    '''
+    if subvol_data.max() <= background_threshold:
+        return True
+    return background_max_std != '' and subvol_data.std() <= float(background_max_std)
+
+def vol_chunk_shape(vol_shape):
+    '''
+    Returns the chunk shape of the volume dataset or None for a contiguous layout. Chunks are
+    aligned to the sub-volume grid so that a sub-volume is read from whole chunks.
+    '''
+    if vol_chunk_layout.upper() != 'YES' and not vol_compression:
+        return None
+    divisor = max(int(vol_chunk_divisor), 1)
+    sub_vol_shape = (il_sub_vol_x, il_sub_vol_y, il_sub_vol_z)
+    chunks = []
+    for dim, sub_vol_dim in zip(vol_shape, sub_vol_shape):
+        chunks.append(max(1, min(int(dim), int(math.ceil(sub_vol_dim / divisor)))))
+    return tuple(chunks)
+
+def vol_compression_args():
+    '''
+    Returns the h5py create_dataset() keyword arguments for the requested volume compression.
+    '''
+    if not vol_compression:
+        return {}
+    compression = vol_compression.lower()
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': int(vol_compression_level), 'shuffle': True}
+    if compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    if compression == 'blosc':
+        # Blosc is not built into h5py, its filter is provided by the hdf5plugin package.
+        import hdf5plugin
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=int(vol_compression_level),
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError("Unknown volume compression %s, use '', 'gzip', 'lzf' or 'blosc'" % vol_compression)
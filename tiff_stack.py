@@ -0,0 +1,138 @@
+#!/usr/bin/env python 
+
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+Reads the image slices of a TIFF stack. A stack is a directory of TIFF files, each file holds one 2D
+image or many 2D pages (multi-page TIFF and BigTIFF). A slice is referred to by (file name, page).
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import threading
+from collections import OrderedDict
+from glob import glob
+import numpy as np
+import tifffile
+
+__author__ = "Mehdi Tondravi"
+__copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['list_tiff_slices',
+           'tiff_slice_info',
+           'read_tiff_slice']
+
+# Open TIFF files kept by each thread, multi-page files are read one page at a time.
+_max_open_files = 8
+_open_files = threading.local()
+
+
+def list_tiff_slices(tiff_location):
+    """
+    Returns the (file name, page) of every slice of the TIFF files in tiff_location. Files are sorted by
+    name and pages are in file order. Only the TIFF headers are read.
+    """
+    slices = []
+    for filename in sorted(glob(tiff_location + '/*.tif*')):
+        with tifffile.TiffFile(filename) as tiff:
+            series_shape = tiff.series[0].shape
+        page_count = series_shape[0] if len(series_shape) > 2 else 1
+        slices.extend((filename, page) for page in range(page_count))
+    return slices
+
+
+def tiff_slice_info(slice_ref):
+    """
+    Returns the 2D shape and dtype of a slice from the TIFF header, without decoding the image.
+    """
+    with tifffile.TiffFile(slice_ref[0]) as tiff:
+        series = tiff.series[0]
+        return tuple(series.shape[-2:]), np.dtype(series.dtype)
+
+
+def read_tiff_slice(slice_ref, memmap=False):
+    """
+    Reads one slice of a TIFF file. With memmap=True a read-only memory map of uncompressed image data is
+    returned instead of decoding it, compressed data is always decoded. Open files are kept per thread so
+    that successive pages of a multi-page file do not parse the file again.
+    """
+    filename, page = slice_ref
+    if memmap:
+        mapped = _cached_file(filename, 'memmap')
+        if mapped is not None:
+            return mapped[page] if mapped.ndim > 2 else mapped
+    tiff = _cached_file(filename, 'tiff')
+    if len(tiff.series[0].shape) > 2:
+        return tiff.asarray(key=page, series=0)
+    return tiff.asarray(series=0)
+
+
+def _cached_file(filename, kind):
+    """
+    Returns this thread's open TiffFile ('tiff') or memory map ('memmap', None if the image data can not
+    be memory mapped) of a file. The least recently used files are closed.
+    """
+    cache = getattr(_open_files, 'cache', None)
+    if cache is None:
+        cache = _open_files.cache = OrderedDict()
+    key = (filename, kind)
+    if key in cache:
+        handle = cache.pop(key)
+    elif kind == 'memmap':
+        try:
+            handle = tifffile.memmap(filename, mode='r')
+        except ValueError:
+            # Compressed or tiled image data can not be memory mapped.
+            handle = None
+    else:
+        handle = tifffile.TiffFile(filename)
+    cache[key] = handle
+    while len(cache) > _max_open_files:
+        (old_name, old_kind), old_handle = cache.popitem(last=False)
+        if old_kind == 'tiff':
+            old_handle.close()
+    return handle
@@ -54,11 +54,19 @@ from __future__ import (absolute_import, division, print_function,
 
 import h5py
 import numpy as np
-from skimage.io import imread
 from glob import glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import itertools
+import json
+import math
+import threading
 import os.path
 from segmentation_param import *
-from mpi4py import MPI
+from tiff_stack import list_tiff_slices, tiff_slice_info, read_tiff_slice
+from volume_backend import create_external_volume
+from executor import MPI, get_executor
 import time
 import pdb
 
@@ -67,6 +75,11 @@ __copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
 __all__ = ['tiff_to_hdf5_files']
 
+_manifest_name = 'ingest_manifest.json'
+# Checksums of tiff files, shared by the decode threads.
+_checksums = {}
+_checksum_lock = threading.Lock()
+
 def tiff_to_hdf5_files():
     """
     Converts reconstructed tiff image files into a hdf5 file.
@@ -80,7 +93,14 @@ def tiff_to_hdf5_files():
     then the HDF file created is:
     ~/projects//eva_block_hdf/data_00860.tiff_data_01139.tiff.hdf5
     and HDF5 data set name is "eva_block".
-    Division of work among ranks/processes is based on a tiff file.
+    A tiff file holds one image or, for multi-page tiff and BigTIFF files, many images. Each image is a
+    slice of the volume. Each rank/process converts a contiguous block of slices.
+    A manifest of the converted tiff files is kept next to the hdf5 file. When ingest_resume is 'yes' a
+    rerun only converts new or changed tiff files into the existing hdf5 file.
+    With the 'external' volume_backend the hdf5 dataset refers to the image data of uncompressed tiff files
+    and nothing is copied. With the 'tiff' volume_backend nothing is done.
+    When ingest_pyramid_factors is set the downsampled levels of the volume are computed from the same
+    batches and written to the 'pyramid' group of the hdf5 file.
     
     Input: Tiff files location is specified in the seg_user_param.py file.
     
@@ -88,78 +108,737 @@ def tiff_to_hdf5_files():
     
     """
     
-    comm = MPI.COMM_WORLD
+    executor = get_executor()
+    comm = executor.comm
     rank = comm.Get_rank()
-    size = MPI.COMM_WORLD.Get_size()
+    size = comm.Get_size()
     name = MPI.Get_processor_name()
     start_time = int(time.time())
-    files = sorted(glob(tiff_files_location + '/*.tif*'))
+    # A slice is a page of a tiff file, a file can have one or many pages. Only the headers are read.
+    slices = None
+    if rank == 0:
+        slices = list_tiff_slices(tiff_files_location)
+    slices = comm.bcast(slices, root=0)
     parent_dir, tiff_dir = os.path.split(tiff_files_location)
     hdf_dir = parent_dir + '/' + tiff_dir + '_' + 'mpi' + '_hdf'
     
     # if there is no tiff return.
-    if not files:
+    if not slices:
         print("**** Did not find any TIFF file, terminating execution ****")
         return
     
-    # Remove all *.hdf5 files from previous runs. Create directory if it does not exist
+    if volume_backend.lower() == 'tiff':
+        if rank == 0:
+            print("**** Volume backend is 'tiff', TIFF files are read directly and are not converted ****")
+        return
+    
+    # Create directory if it does not exist.
     if rank == 0:
         print("**** File location is ****", hdf_dir)
-        if os.path.exists(hdf_dir):
-           hdf5_files =  glob(hdf_dir + '/*.hdf5')
-           for file in hdf5_files:
-               print("*** Removing file ***", file)
-               os.remove(file)
         if not os.path.exists(hdf_dir):
             print("*** Creating directory ***", hdf_dir)
             os.mkdir(hdf_dir)
-    comm.Barrier()
     
-    # Get the shape and dtype of tiff file - all tiff files have the same shape and type.
-    data_shape = imread(files[0], plugin='tifffile').shape
-    data_type = imread(files[0], plugin='tifffile').dtype
+    # Get the shape and dtype of tiff file from its header - all tiff files have the same shape and type.
+    data_shape, data_type = tiff_slice_info(slices[0])
     
-    first_file_name, first_file_ext = os.path.splitext(os.path.basename(files[0]))
-    last_file_name, last_file_ext = os.path.splitext(os.path.basename(files[-1]))
+    first_file_name, first_file_ext = os.path.splitext(os.path.basename(slices[0][0]))
+    last_file_name, last_file_ext = os.path.splitext(os.path.basename(slices[-1][0]))
     hdf_file_name = hdf_dir + '/'+first_file_name + '_' + last_file_name + '.hdf5'
+    data_set_name = tiff_dir
+    vol_shape = (len(slices), data_shape[0], data_shape[1])
+    chunks = vol_chunk_shape(vol_shape)
+    # The volume can be stored with a lower bit depth than the tiff files.
+    vol_type = np.dtype(ingest_output_dtype) if ingest_output_dtype else np.dtype(data_type)
+    layout = {'dataset': data_set_name, 'shape': list(data_shape), 'dtype': vol_type.str,
+              'source_dtype': np.dtype(data_type).str,
+              'chunks': list(chunks) if chunks is not None else None,
+              'compression': vol_compression, 'compression_level': vol_compression_level}
+    if ingest_output_dtype:
+        layout['clip_percentiles'] = list(ingest_clip_percentiles)
+    pyramid_factors = sorted(set(int(factor) for factor in ingest_pyramid_factors if int(factor) > 1))
+    if pyramid_factors:
+        layout['pyramid'] = pyramid_factors
+    
+    # The external backend stores only references to the TIFF image data in the hdf5 file.
+    if volume_backend.lower() == 'external':
+        external_created = False
+        if rank == 0:
+            for file in glob(hdf_dir + '/*.hdf5') + glob(hdf_dir + '/' + _manifest_name + '*'):
+                print("*** Removing file ***", file)
+                os.remove(file)
+            external_created = create_external_volume(slices, hdf_file_name, data_set_name)
+        if comm.bcast(external_created, root=0):
+            if rank == 0:
+                print("Done creating external volume file %s, exec time is %d sec" % (hdf_file_name, int(time.time()) - start_time))
+            return
+        if rank == 0:
+            print("**** Can not use TIFF files as external storage, converting TIFF files ****")
+    
+    # Rank 0 decides if the volume file of a previous run can be updated in place, otherwise all *.hdf5
+    # files from previous runs are removed.
+    # The statistics recorded in the manifest are only valid after a run has saved them, a run that is
+    # killed leaves the statistics of its written slices unsaved.
+    written_slices = None
+    previous_stats = None
+    if rank == 0:
+        written_slices = _load_manifest(hdf_dir, hdf_file_name, layout, len(slices))
+        if written_slices is None:
+            for file in glob(hdf_dir + '/*.hdf5') + glob(hdf_dir + '/' + _manifest_name + '*'):
+                print("*** Removing file ***", file)
+                os.remove(file)
+        else:
+            previous_stats = _read_manifest(hdf_dir).get('stats')
+        _save_manifest(hdf_dir, layout, len(slices), written_slices or {}, _stats_spec(None))
+    written_slices = comm.bcast(written_slices, root=0)
+    previous_stats = comm.bcast(previous_stats, root=0)
+    slice_indices = _pending_slices(slices, written_slices, comm)
+    if pyramid_factors:
+        # A pyramid block is computed from all of its slices, changed slices are converted with their blocks.
+        align = _slice_alignment(chunks, pyramid_factors)
+        slice_indices = sorted(set(itertools.chain.from_iterable(
+            range(slice_idx - slice_idx % align, min(slice_idx - slice_idx % align + align, len(slices)))
+            for slice_idx in slice_indices)))
+    if rank == 0:
+        print("*** Number of slices is %d, number of slices to convert is %d ***" % (len(slices), len(slice_indices)))
+    
+    # Intensity levels mapped to the range of the volume type, a resumed volume keeps its levels.
+    requant = None
+    if ingest_output_dtype:
+        levels = None
+        if rank == 0 and written_slices is not None:
+            with h5py.File(hdf_file_name, 'r') as hdf_file:
+                if 'requantize_levels' in hdf_file[data_set_name].attrs:
+                    levels = tuple(float(level) for level in hdf_file[data_set_name].attrs['requantize_levels'])
+        levels = comm.bcast(levels, root=0)
+        if levels is None:
+            levels = _requantize_levels(slices, data_type, executor)
+        requant = (levels[0], levels[1], vol_type.str)
+    
     file_time = time.time()
+    file_mode = 'w' if written_slices is None else 'r+'
     # Need Parallel HDF for faster processing. However the below test lets processing to continue even if
     # Parallel HDF is not available.
     if size == 1:
-        hdf_file = h5py.File(hdf_file_name, 'w')
+        hdf_file = h5py.File(hdf_file_name, file_mode)
     else:
-        hdf_file = h5py.File(hdf_file_name, 'w', driver='mpio', comm=comm)
-    data_set_name = tiff_dir
+        hdf_file = h5py.File(hdf_file_name, file_mode, driver='mpio', comm=comm)
     if rank == 0:
         print("*** Dataset name is %s and file create time is %d***" % (data_set_name, (time.time() - file_time)))
     ds_time = time.time()
-    data_set = hdf_file.create_dataset(data_set_name, (len(files), data_shape[0], data_shape[1]), data_type)
+    if written_slices is None:
+        # A chunked volume can grow when slices are appended in a later run.
+        maxshape = (None,) + vol_shape[1:] if chunks is not None else None
+        data_set = hdf_file.create_dataset(data_set_name, vol_shape, vol_type, chunks=chunks, maxshape=maxshape,
+                                           **vol_compression_args())
+    else:
+        data_set = hdf_file[data_set_name]
+        if data_set.shape[0] != len(slices):
+            data_set.resize(len(slices), axis=0)
+    levels = _pyramid_datasets(hdf_file, data_set, pyramid_factors, written_slices is None)
+    # Make the dataset metadata durable so that a killed run leaves a volume file that can be resumed.
+    hdf_file.flush()
     if rank == 0:
-        print("dataset creatation time is %d" % (time.time() - ds_time))
-    iterations = int(len(files) / size) + (len(files) % size > 0)
-    for idx in range(iterations):
+        print("dataset creatation time is %d, chunk shape is %s, compression is %s" %
+              ((time.time() - ds_time), chunks, data_set.compression))
+    # Range of the intensity histograms, the range of a previous run is kept so that histograms can be merged.
+    hist_spec = None
+    if ingest_stats.upper() == 'YES':
         if rank == 0:
-            if idx == 0:
-                print("***** starting to convert TIFF files ***")
-        if (rank + (size * idx)) >= len(files):
-            print("\nBREAKING out, my rank is %d, number of files is %d, size is %d and idx is %d" %
-                  (rank, len(files), size, idx))
-            break
-        imread_start = time.time()
-        imarray = imread(files[rank + size * idx], plugin='tifffile')
-        data_set[(rank + size * idx), :, :] = imarray
-        imread_end = time.time()
-        if idx % 50 == 0:
-            print("IM Read done, rank is %d, idx is %d, time for read is %d sec, number of bytes %d, element size %d, file is %s" % 
-                  (rank, idx, (imread_end - imread_start), imarray.nbytes, imarray.itemsize, files[rank + size * idx]))
+            hist_spec = _histogram_spec(slices, vol_type, int(ingest_hist_bins),
+                                        hdf_file_name if written_slices is not None else None)
+        hist_spec = comm.bcast(hist_spec, root=0)
+    # Statistics of a previous run with other histogram bins, range or background threshold, or without
+    # statistics, can not be merged. The statistics of the slices that are not converted are then computed
+    # from the volume.
+    restat_slices = []
+    if hist_spec is not None and previous_stats != _stats_spec(hist_spec):
+        restat_slices = sorted(set(range(len(slices))) - set(slice_indices))
+        if rank == 0 and restat_slices:
+            print("*** Statistics of the previous run differ, computing statistics of %d written slices ***" %
+                  len(restat_slices))
+    journal = open(hdf_dir + '/' + _manifest_name + '.rank' + str(rank).zfill(5), 'a')
+    slice_stats = _write_slice_batches(slices, data_set, executor, slice_indices, journal, hist_spec, requant, levels)
+    journal.close()
+    executor.close()
+    if restat_slices:
+        _volume_stats(data_set, restat_slices, hist_spec, slice_stats, comm)
     
     print("data shape is, rank is", data_set.shape, rank)
     hdf_file.close()
+    # Each slice has been converted by one rank, the sum over ranks gathers the statistics of all slices.
+    if slice_stats is not None:
+        for key in sorted(slice_stats):
+            total = np.zeros_like(slice_stats[key]) if rank == 0 else None
+            comm.Reduce(slice_stats[key], total, op=MPI.SUM, root=0)
+            slice_stats[key] = total
+    comm.Barrier()
+    if rank == 0:
+        if requant is not None:
+            with h5py.File(hdf_file_name, 'r+') as hdf_file:
+                hdf_file[data_set_name].attrs['requantize_levels'] = np.array(requant[:2])
+                hdf_file[data_set_name].attrs['source_dtype'] = np.dtype(data_type).str
+        if slice_stats is not None:
+            _save_stats(hdf_file_name, data_set_name, slice_stats, hist_spec)
+        else:
+            with h5py.File(hdf_file_name, 'r+') as hdf_file:
+                if 'stats' in hdf_file:
+                    del hdf_file['stats']
+        _save_manifest(hdf_dir, layout, len(slices), _read_manifest(hdf_dir)['slices'], _stats_spec(hist_spec))
     end_time = int(time.time())
     exec_time = end_time - start_time
     print("Done dividing tiff files, rank is %d, size is %d, name is %s, exec time is %d sec" % (rank, size, name, exec_time))
 
 
+def _write_slice_batches(slices, data_set, executor, slice_indices, journal, hist_spec, requant, levels):
+    """
+    Each rank converts a contiguous block of tiff files. The files of a batch are decoded ahead of the
+    writes by a thread pool and copied into one array that is written to the volume with a single call.
+    On a chunked volume blocks and batches are aligned to the chunk depth so that no chunk is shared by
+    two ranks. Compressed datasets can only be written collectively with Parallel HDF, so every rank then
+    takes part in the same number of writes.
+    Only the slices in slice_indices are written. Each written slice is recorded in the rank's manifest
+    journal after a flush of the file that covers it. The flush is collective with Parallel HDF, so every
+    rank flushes the file after each batch and takes part in the same number of flushes.
+    
+    Images are requantized to the volume type when requant is not None, see _decode_slice().
+    The pyramid levels, a dictionary of datasets keyed by downsampling factor, are computed from each batch,
+    batches are then aligned to the factors too.
+    Returns the statistics of the slices written by this rank, zero for other slices, or None if
+    hist_spec is None.
+    """
+    comm = executor.comm
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    align = _slice_alignment(data_set.chunks, sorted(levels))
+    batch_slices = int(math.ceil(max(int(ingest_batch_slices), 1) / align)) * align
+    collective = size > 1 and (ingest_collective_io.upper() == 'YES' or data_set.compression is not None)
+    my_slices = _rank_slices(slice_indices, rank, size, align)
+    batches = _make_batches(my_slices, batch_slices)
+    iterations = len(batches)
+    if size > 1:
+        iterations = comm.allreduce(iterations, op=MPI.MAX)
+    if rank == 0:
+        print("***** starting to convert TIFF files, batch size is %d, collective is %s ***" % (batch_slices, collective))
+    if my_slices:
+        print("rank is %d, slices %d:%d, number of batches is %d" % (rank, my_slices[0], my_slices[-1] + 1, len(batches)))
+    # TIFF files are decoded by a thread pool, or the worker processes of the local executor, while the
+    # batches are written.
+    decoded_slices = _decode_slices(slices, my_slices, hist_spec, requant, executor)
+    slice_stats = None
+    if hist_spec is not None:
+        slice_stats = {'converted': np.zeros((len(slices),), dtype='uint8'),
+                       'histogram': np.zeros((len(slices), hist_spec[2]), dtype='uint64'),
+                       'slice_min': np.zeros((len(slices),), dtype='float64'),
+                       'slice_max': np.zeros((len(slices),), dtype='float64'),
+                       'slice_sum': np.zeros((len(slices),), dtype='float64'),
+                       'foreground_count': np.zeros((len(slices),), dtype='uint64')}
+    bytes_written = 0
+    read_time = 0.0
+    write_time = 0.0
+    for idx in range(iterations):
+        if idx >= len(batches):
+            if collective:
+                for level_set in [data_set] + [levels[factor] for factor in sorted(levels)]:
+                    _write_slab(level_set, 0, None, collective)
+            data_set.file.flush()
+            continue
+        batch_start, batch_end = batches[idx]
+        imread_start = time.time()
+        slab = np.empty((batch_end - batch_start,) + data_set.shape[1:], dtype=data_set.dtype)
+        slice_records = {}
+        for slice_idx in range(batch_start, batch_end):
+            decoded_idx, imarray, slice_records[slice_idx], stats = next(decoded_slices)
+            slab[slice_idx - batch_start, :, :] = imarray
+            if stats is not None:
+                slice_stats['converted'][slice_idx] = 1
+                for key in stats:
+                    slice_stats[key][slice_idx] = stats[key]
+        imread_end = time.time()
+        _write_slab(data_set, batch_start, slab, collective)
+        for factor, level_slab in sorted(_downsample_slab(slab, sorted(levels)).items()):
+            _write_slab(levels[factor], batch_start // factor, level_slab, collective)
+        data_set.file.flush()
+        write_end = time.time()
+        for slice_idx in range(batch_start, batch_end):
+            journal.write(json.dumps([slice_idx, slice_records[slice_idx]]) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+        bytes_written += slab.nbytes
+        read_time += imread_end - imread_start
+        write_time += write_end - imread_end
+        if idx % 10 == 0:
+            print("Batch written, rank is %d, slices %d:%d, time for read is %d sec, time for write is %d sec" %
+                  (rank, batch_start, batch_end, (imread_end - imread_start), (write_end - imread_end)))
+    _report_throughput(comm, bytes_written, read_time, write_time)
+    return slice_stats
+
+
+def _pyramid_datasets(hdf_file, data_set, pyramid_factors, create):
+    """
+    Creates, or opens and resizes when create is False, the 'pyramid/<factor>x' datasets of the volume
+    file. Returns a dictionary of the datasets keyed by downsampling factor.
+    """
+    levels = {}
+    for factor in pyramid_factors:
+        level_shape = tuple(int(math.ceil(dim / factor)) for dim in data_set.shape)
+        level_name = 'pyramid/%dx' % factor
+        if create:
+            level_chunks = None
+            maxshape = None
+            if data_set.chunks is not None:
+                level_chunks = tuple(min(chunk, dim) for chunk, dim in zip(data_set.chunks, level_shape))
+                maxshape = (None,) + level_shape[1:]
+            level_set = hdf_file.create_dataset(level_name, level_shape, data_set.dtype, chunks=level_chunks,
+                                                maxshape=maxshape, **vol_compression_args())
+            level_set.attrs['downsample_factor'] = factor
+        else:
+            level_set = hdf_file[level_name]
+            if level_set.shape[0] != level_shape[0]:
+                level_set.resize(level_shape[0], axis=0)
+        levels[factor] = level_set
+    return levels
+
+
+def _downsample_slab(slab, factors):
+    """
+    Returns the block means of a slab of slices for each downsampling factor, the slab starts at a multiple
+    of the factors. Blocks at the end of the volume that are not full are averaged over the voxels they have.
+    The block sums of a factor are reduced from the block sums of the largest smaller factor dividing it.
+    """
+    block_sums = {1: slab}
+    level_slabs = {}
+    for factor in factors:
+        base = max(base for base in block_sums if factor % base == 0)
+        step = factor // base
+        sums = block_sums[base]
+        for axis in range(3):
+            sums = np.add.reduceat(sums, np.arange(0, sums.shape[axis], step), axis=axis, dtype='float64')
+        block_sums[factor] = sums
+        counts = [np.diff(np.append(np.arange(0, dim, factor), dim)) for dim in slab.shape]
+        means = sums / (counts[0][:, None, None] * counts[1][None, :, None] * counts[2][None, None, :])
+        if np.issubdtype(slab.dtype, np.integer):
+            means = np.rint(means)
+        level_slabs[factor] = means.astype(slab.dtype)
+    return level_slabs
+
+
+def _slice_alignment(chunks, pyramid_factors):
+    """
+    Returns the number of slices that rank blocks and batches are aligned to, the least common multiple
+    of the chunk depth and the pyramid factors.
+    """
+    align = chunks[0] if chunks is not None else 1
+    for factor in pyramid_factors:
+        multiple = align
+        while multiple % factor != 0:
+            multiple += align
+        align = multiple
+    return align
+
+
+def _decode_slices(slices, slice_indices, hist_spec, requant, executor):
+    """
+    Yields (slice index, image, manifest record, statistics) for the given slice indices in order, see
+    _decode_slice().
+    """
+    decoded_slices = _prefetch_map(_decode_slice, [slices[slice_idx] for slice_idx in slice_indices], executor,
+                                   hist_spec, requant)
+    for slice_idx, decoded in zip(slice_indices, decoded_slices):
+        yield (slice_idx,) + decoded
+
+
+def _prefetch_map(func, items, executor, *args):
+    """
+    Yields func(item, *args) for the items in order. The calls are made by the worker processes of the
+    local executor or else by ingest_decode_threads threads, at most ingest_queue_depth items ahead of the
+    consumer.
+    """
+    if executor.backend == 'local':
+        for result in executor.imap(func, items, *args):
+            yield result
+        return
+    threads = int(ingest_decode_threads) if ingest_decode_threads else 0
+    if threads < 1:
+        for item in items:
+            yield func(item, *args)
+        return
+    queue_depth = max(int(ingest_queue_depth), 1)
+    item_iter = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for item in itertools.islice(item_iter, queue_depth):
+            pending.append(pool.submit(func, item, *args))
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(item_iter, 1):
+                pending.append(pool.submit(func, item, *args))
+            yield result
+
+
+def _decode_slice(slice_ref, hist_spec, requant):
+    """
+    Returns the image of a slice, its manifest record and its statistics, None if hist_spec is None.
+    If requant is (low, high, dtype) the image is requantized to dtype, see _requantize().
+    """
+    imarray = _read_slice(slice_ref)
+    if requant is not None:
+        imarray = _requantize(imarray, requant)
+    stats = _image_stats(imarray, hist_spec) if hist_spec is not None else None
+    return imarray, _slice_record(slice_ref), stats
+
+
+def _requantize(imarray, requant):
+    """
+    Linearly maps intensities from low to high onto the full range of the integer type dtype, intensities
+    outside are clipped.
+    """
+    low, high, dtype = requant
+    max_value = np.iinfo(dtype).max
+    scaled = (imarray.astype('float32') - low) * (max_value / (high - low)) + 0.5
+    return np.clip(scaled, 0, max_value).astype(dtype)
+
+
+def _requantize_levels(slices, data_type, executor):
+    """
+    Streaming histogram pass over all tiff files to find the intensities at ingest_clip_percentiles of
+    the volume. The tiff files are divided among ranks and the histograms are summed with MPI.
+    """
+    comm = executor.comm
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    start_time = time.time()
+    hist_spec = None
+    if rank == 0:
+        hist_spec = _histogram_spec(slices, data_type, int(ingest_requant_bins), None)
+    hist_spec = comm.bcast(hist_spec, root=0)
+    histogram = np.zeros((hist_spec[2],), dtype='float64')
+    extremes = np.array([np.inf, -np.inf])
+    my_slices = _rank_slices(list(range(len(slices))), rank, size, 1)
+    for stats in _prefetch_map(_read_slice_stats, [slices[slice_idx] for slice_idx in my_slices], executor, hist_spec):
+        histogram += stats['histogram']
+        extremes = np.array([min(extremes[0], stats['slice_min']), max(extremes[1], stats['slice_max'])])
+    total = np.zeros_like(histogram)
+    comm.Allreduce(histogram, total, op=MPI.SUM)
+    low = comm.allreduce(float(extremes[0]), op=MPI.MIN)
+    high = comm.allreduce(float(extremes[1]), op=MPI.MAX)
+    # Values outside the histogram range are counted in the end bins, which then extend to the extremes.
+    edges = np.linspace(hist_spec[0], hist_spec[1], hist_spec[2] + 1)
+    edges[0] = min(edges[0], low)
+    edges[-1] = max(edges[-1], high)
+    cdf = np.concatenate(([0.0], np.cumsum(total))) / total.sum()
+    levels = np.interp(np.array(ingest_clip_percentiles, dtype='float64') / 100.0, cdf, edges)
+    levels = (float(levels[0]), float(levels[1]) if levels[1] > levels[0] else float(levels[0]) + 1.0)
+    if rank == 0:
+        print("*** Requantize levels at percentiles %s are %s, histogram pass time is %d sec ***" %
+              (ingest_clip_percentiles, levels, (time.time() - start_time)))
+    return levels
+
+
+def _read_slice_stats(slice_ref, hist_spec):
+    """
+    Returns the statistics of the image of a slice, see _image_stats().
+    """
+    return _image_stats(_read_slice(slice_ref), hist_spec)
+
+
+def _image_stats(imarray, hist_spec):
+    """
+    Returns the intensity histogram, min, max, sum and number of foreground voxels (intensity above
+    background_threshold) of an image. The histogram has hist_spec = (low, high, bins) bins, values
+    outside low to high are counted in the first or last bin.
+    """
+    low, high, bins = hist_spec
+    if imarray.min() < low or imarray.max() > high:
+        hist_data = np.clip(imarray, low, high)
+    else:
+        hist_data = imarray
+    histogram, edges = np.histogram(hist_data, bins=bins, range=(low, high))
+    return {'histogram': histogram,
+            'slice_min': imarray.min(),
+            'slice_max': imarray.max(),
+            'slice_sum': imarray.sum(dtype='float64'),
+            'foreground_count': np.count_nonzero(imarray > background_threshold)}
+
+
+def _histogram_spec(slices, data_type, bins, hdf_file_name):
+    """
+    Returns the (low, high, bins) of an intensity histogram. Integer images use the range of their type,
+    with at most one bin per value. The range of a resumed volume is taken from its stored statistics,
+    otherwise the range of floating point images is estimated from the first, middle and last tiff file.
+    """
+    if hdf_file_name is not None:
+        with h5py.File(hdf_file_name, 'r') as hdf_file:
+            if 'stats/histogram_edges' in hdf_file:
+                edges = hdf_file['stats/histogram_edges'][...]
+                if len(edges) == bins + 1:
+                    return float(edges[0]), float(edges[-1]), bins
+    if np.issubdtype(data_type, np.integer):
+        type_info = np.iinfo(data_type)
+        value_count = int(type_info.max) - int(type_info.min) + 1
+        return float(type_info.min), float(type_info.max) + 1.0, min(bins, value_count)
+    # Outliers are ignored so that the bins resolve the bulk of the intensities.
+    samples = [_read_slice(slices[slice_idx]) for slice_idx in sorted(set([0, len(slices) // 2, len(slices) - 1]))]
+    low, high = np.percentile(np.concatenate([sample.ravel() for sample in samples]), [0.1, 99.9])
+    margin = 0.5 * (high - low)
+    low, high = float(low - margin), float(high + margin)
+    return low, high if high > low else low + 1.0, bins
+
+
+def _stats_spec(hist_spec):
+    """
+    Returns the manifest record of the statistics saved in the volume file, computed with hist_spec or not
+    computed if hist_spec is None.
+    """
+    if hist_spec is None:
+        return {'enabled': False}
+    return {'enabled': True, 'histogram': [float(hist_spec[0]), float(hist_spec[1]), int(hist_spec[2])],
+            'background_threshold': float(background_threshold)}
+
+
+def _volume_stats(data_set, slice_indices, hist_spec, slice_stats, comm):
+    """
+    Computes the statistics of the given slices from the images written to the volume dataset and adds them
+    to slice_stats. The slices are divided among ranks in blocks of the chunk depth.
+    """
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    align = data_set.chunks[0] if data_set.chunks is not None else 1
+    batch_slices = int(math.ceil(max(int(ingest_batch_slices), 1) / align)) * align
+    for batch_start, batch_end in _make_batches(_rank_slices(slice_indices, rank, size, align), batch_slices):
+        slab = data_set[batch_start:batch_end, :, :]
+        for slice_idx in range(batch_start, batch_end):
+            stats = _image_stats(slab[slice_idx - batch_start], hist_spec)
+            slice_stats['converted'][slice_idx] = 1
+            for key in stats:
+                slice_stats[key][slice_idx] = stats[key]
+
+
+def _save_stats(hdf_file_name, data_set_name, slice_stats, hist_spec):
+    """
+    Writes the per slice statistics into the 'stats' group of the volume file and the whole volume
+    statistics as attributes of the volume dataset. Statistics of slices that were not converted in this
+    run are kept from the previous run, the manifest records if they can be kept, see _stats_spec().
+    """
+    with h5py.File(hdf_file_name, 'r+') as hdf_file:
+        data_set = hdf_file[data_set_name]
+        slice_voxels = float(data_set.shape[1] * data_set.shape[2])
+        converted = slice_stats['converted'].astype(bool)
+        slice_stats['slice_mean'] = slice_stats.pop('slice_sum') / slice_voxels
+        slice_stats['slice_foreground_fraction'] = slice_stats.pop('foreground_count') / slice_voxels
+        stats_group = hdf_file.require_group('stats')
+        for key in ['histogram', 'slice_min', 'slice_max', 'slice_mean', 'slice_foreground_fraction']:
+            if key in stats_group:
+                if not converted.all():
+                    previous = stats_group[key][...]
+                    kept = min(len(previous), len(converted))
+                    keep = ~converted[:kept]
+                    slice_stats[key][:kept][keep] = previous[:kept][keep]
+                del stats_group[key]
+            stats_group.create_dataset(key, data=slice_stats[key])
+        if 'histogram_edges' in stats_group:
+            del stats_group['histogram_edges']
+        stats_group.create_dataset('histogram_edges', data=np.linspace(hist_spec[0], hist_spec[1], hist_spec[2] + 1))
+        stats_group.attrs['background_threshold'] = background_threshold
+        data_set.attrs['min'] = slice_stats['slice_min'].min()
+        data_set.attrs['max'] = slice_stats['slice_max'].max()
+        data_set.attrs['mean'] = slice_stats['slice_mean'].mean()
+        data_set.attrs['foreground_fraction'] = slice_stats['slice_foreground_fraction'].mean()
+        print("*** Saved volume statistics, min %g, max %g, mean %g, foreground fraction %.3f ***" %
+              (data_set.attrs['min'], data_set.attrs['max'], data_set.attrs['mean'], data_set.attrs['foreground_fraction']))
+
+
+def _read_slice(slice_ref):
+    """
+    Reads a slice into memory. If ingest_tiff_memmap is 'yes' uncompressed image data is read through a
+    memory map instead of the tifffile decoder, compressed image data is always decoded.
+    """
+    return np.array(read_tiff_slice(slice_ref, memmap=ingest_tiff_memmap.upper() == 'YES'))
+
+
+def _slice_record(slice_ref):
+    """
+    Returns the manifest record of a slice, the name, size, modification time and, if ingest_checksum
+    is set, checksum of its tiff file and its page.
+    """
+    filename, page = slice_ref
+    stat = os.stat(filename)
+    record = {'file': os.path.basename(filename), 'page': page, 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if ingest_checksum:
+        record['checksum'] = _file_checksum(filename, stat.st_size, stat.st_mtime)
+    return record
+
+
+def _file_checksum(filename, file_size, file_mtime):
+    """
+    Returns the ingest_checksum hex digest of a file. Digests are cached by name, size and modification
+    time so that a multi-page file is read once.
+    """
+    key = (filename, file_size, file_mtime)
+    with _checksum_lock:
+        if key in _checksums:
+            return _checksums[key]
+    file_hash = hashlib.new(ingest_checksum)
+    with open(filename, 'rb') as tiff_file:
+        for block in iter(lambda: tiff_file.read(1 << 24), b''):
+            file_hash.update(block)
+    with _checksum_lock:
+        _checksums[key] = file_hash.hexdigest()
+    return _checksums[key]
+
+
+def _pending_slices(slices, written_slices, comm):
+    """
+    Returns the sorted indices of slices that are missing from the volume or whose tiff file has changed
+    since it was written. The tiff files are checked by all ranks and the result is shared.
+    """
+    if written_slices is None:
+        return list(range(len(slices)))
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+    my_pending = []
+    for slice_idx in range(rank, len(slices), size):
+        written = written_slices.get(str(slice_idx))
+        if written is None:
+            my_pending.append(slice_idx)
+            continue
+        record = _slice_record(slices[slice_idx])
+        if 'checksum' not in written:
+            record.pop('checksum', None)
+        if record != written:
+            my_pending.append(slice_idx)
+    return sorted(itertools.chain.from_iterable(comm.allgather(my_pending)))
+
+
+def _load_manifest(hdf_dir, hdf_file_name, layout, slice_count):
+    """
+    Returns the slices recorded in the manifest of a previous run as a dictionary keyed by slice index,
+    or None if the volume file has to be created from scratch. The volume file of the previous run is
+    renamed to hdf_file_name when the first or last tiff file has changed.
+    """
+    if ingest_resume.upper() != 'YES':
+        return None
+    manifest = _read_manifest(hdf_dir)
+    hdf5_files = glob(hdf_dir + '/*.hdf5')
+    if manifest is None or manifest['layout'] != layout or len(hdf5_files) != 1:
+        return None
+    try:
+        with h5py.File(hdf5_files[0], 'r') as hdf_file:
+            data_set = hdf_file[layout['dataset']]
+            # A contiguous volume can not change its number of slices.
+            if layout['chunks'] is None and data_set.shape[0] != slice_count:
+                return None
+    except (IOError, OSError, KeyError):
+        print("*** Volume file of the previous run can not be opened, converting all slices ***")
+        return None
+    if hdf5_files[0] != hdf_file_name:
+        print("*** Renaming file %s to %s ***" % (hdf5_files[0], hdf_file_name))
+        os.rename(hdf5_files[0], hdf_file_name)
+    print("*** Resuming from manifest with %d written slices ***" % len(manifest['slices']))
+    return manifest['slices']
+
+
+def _read_manifest(hdf_dir):
+    """
+    Reads the manifest and merges the journals written by the ranks of an unfinished run into it.
+    """
+    manifest_file = hdf_dir + '/' + _manifest_name
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as mfile:
+        manifest = json.load(mfile)
+    for journal_file in sorted(glob(manifest_file + '.rank*')):
+        with open(journal_file) as jfile:
+            for line in jfile:
+                try:
+                    slice_idx, record = json.loads(line)
+                except ValueError:
+                    # Last line of a killed run may be incomplete.
+                    continue
+                manifest['slices'][str(slice_idx)] = record
+    return manifest
+
+
+def _save_manifest(hdf_dir, layout, slice_count, slices, stats):
+    """
+    Atomically replaces the manifest file with the given layout, slices and statistics record (see
+    _stats_spec()), dropping slices beyond slice_count, and removes the rank journals.
+    """
+    manifest_file = hdf_dir + '/' + _manifest_name
+    slices = dict((key, value) for key, value in slices.items() if int(key) < slice_count)
+    manifest = {'layout': layout, 'slice_count': slice_count, 'slices': slices, 'stats': stats}
+    with open(manifest_file + '.tmp', 'w') as mfile:
+        json.dump(manifest, mfile)
+        mfile.flush()
+        os.fsync(mfile.fileno())
+    os.rename(manifest_file + '.tmp', manifest_file)
+    for journal_file in glob(manifest_file + '.rank*'):
+        os.remove(journal_file)
+
+
+def _rank_slices(slice_indices, rank, size, align):
+    """
+    Returns the contiguous block of the sorted slice indices converted by this rank. Block boundaries
+    fall on multiples of align.
+    """
+    units = sorted(set(slice_idx // align for slice_idx in slice_indices))
+    my_units = set(units[int(rank * len(units) / size):int((rank + 1) * len(units) / size)])
+    return [slice_idx for slice_idx in slice_indices if slice_idx // align in my_units]
+
+
+def _make_batches(slice_indices, batch_slices):
+    """
+    Groups sorted slice indices into (start, end) runs of consecutive slices that do not cross a
+    multiple of batch_slices.
+    """
+    batches = []
+    for slice_idx in slice_indices:
+        if batches and slice_idx == batches[-1][1] and slice_idx % batch_slices != 0:
+            batches[-1][1] = slice_idx + 1
+        else:
+            batches.append([slice_idx, slice_idx + 1])
+    return [tuple(batch) for batch in batches]
+
+
+def _report_throughput(comm, bytes_written, read_time, write_time):
+    """
+    Prints read and write rates of this rank and, on rank 0, the slowest rank and aggregate write rate.
+    """
+    rank = comm.Get_rank()
+    mbytes = bytes_written / 1e6
+    read_rate = mbytes / read_time if read_time > 0 else 0.0
+    write_rate = mbytes / write_time if write_time > 0 else 0.0
+    print("rank is %d, wrote %.1f MB, read rate is %.1f MB/s, write rate is %.1f MB/s" % (rank, mbytes, read_rate, write_rate))
+    rates = comm.gather((mbytes, read_time + write_time, write_rate), root=0)
+    if rank == 0:
+        total_mbytes = sum(rate[0] for rate in rates)
+        elapsed = max(rate[1] for rate in rates)
+        print("*** Converted %.1f MB, slowest rank write rate is %.1f MB/s, aggregate rate is %.1f MB/s ***" %
+              (total_mbytes, min([rate[2] for rate in rates if rate[0] > 0] or [0.0]), total_mbytes / elapsed if elapsed > 0 else 0.0))
+
+
+def _write_slab(data_set, slab_start, slab, collective):
+    """
+    Writes a slab of slices to the volume dataset starting at slice slab_start. A rank without data
+    passes slab=None to take part in a collective write with an empty selection.
+    """
+    if not collective:
+        data_set[slab_start:slab_start + slab.shape[0], :, :] = slab
+        return
+    if slab is not None:
+        with data_set.collective:
+            data_set[slab_start:slab_start + slab.shape[0], :, :] = slab
+        return
+    # h5py skips writes of empty selections, so the empty collective write goes through the low level API.
+    dxpl = h5py.h5p.create(h5py.h5p.DATASET_XFER)
+    dxpl.set_dxpl_mpio(h5py.h5fd.MPIO_COLLECTIVE)
+    file_space = data_set.id.get_space()
+    file_space.select_none()
+    mem_space = h5py.h5s.create_simple((1,))
+    mem_space.select_none()
+    data_set.id.write(mem_space, file_space, np.zeros((1,), dtype=data_set.dtype), dxpl=dxpl)
+
+
 if __name__ == '__main__':
     tiff_to_hdf5_files()
 
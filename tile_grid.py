@@ -0,0 +1,297 @@
+#!/usr/bin/env python 
+
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+The grid of overlapping tiles (sub-volumes) the volume is divided into for pixel classification.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import hashlib
+import json
+import h5py
+import numpy as np
+from segmentation_param import *
+
+__author__ = "Mehdi Tondravi"
+__copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['TileGrid']
+
+
+class TileGrid(object):
+    """
+    Tiles of tile_shape voxels that cover a volume, the tiles at the end of an axis are cut at the volume
+    boundary. A tile is read with a halo of overlap voxels on each side, the halo is cut at the volume
+    boundary.
+    
+    Tiles are numbered in x, y, z order, z changing fastest. For every tile the arrays (one row per tile)
+    hold its grid coordinates ijk, its core box start:stop in the volume and its left and right halo.
+    Tiles flagged in background are not classified, see make_subvolume_mpi.py.
+    The grid is saved into and loaded from a small HDF5 file so that the stages do not recompute it.
+    """
+    
+    def __init__(self, vol_shape, tile_shape=None, overlap=None):
+        if tile_shape is None:
+            tile_shape = (il_sub_vol_x, il_sub_vol_y, il_sub_vol_z)
+        if overlap is None:
+            overlap = pixeloverlap
+        self.vol_shape = tuple(int(dim) for dim in vol_shape)
+        self.tile_shape = tuple(int(dim) for dim in tile_shape)
+        self.overlap = int(overlap)
+        vol = np.array(self.vol_shape, dtype='int64')
+        tile = np.array(self.tile_shape, dtype='int64')
+        self.grid_shape = tuple(int(dim) for dim in (vol + tile - 1) // tile)
+        self.ijk = np.indices(self.grid_shape).reshape(3, -1).T.astype('int64')
+        self.start = self.ijk * tile
+        self.stop = np.minimum(self.start + tile, vol)
+        self.left = np.minimum(self.overlap, self.start)
+        self.right = np.minimum(self.overlap, vol - self.stop)
+        self.background = np.zeros((len(self.ijk),), dtype=bool)
+    
+    def __len__(self):
+        return self.ijk.shape[0]
+    
+    def __iter__(self):
+        return iter(range(len(self)))
+    
+    def foreground_tiles(self):
+        """
+        Returns the numbers of the tiles that are not flagged as background.
+        """
+        return np.flatnonzero(~self.background)
+    
+    def sample_tiles(self, count):
+        """
+        Returns at most count foreground tiles spread evenly over the foreground tiles, e.g. to try a
+        classifier on a few representative tiles.
+        """
+        tiles = self.foreground_tiles()
+        if len(tiles) == 0 or count < 1:
+            return tiles[:0]
+        return np.unique(tiles[np.linspace(0, len(tiles) - 1, min(int(count), len(tiles))).astype('int64')])
+    
+    def orig_indices(self, tile):
+        """
+        Returns the core box of a tile as [x start, x stop, y start, y stop, z start, z stop].
+        """
+        return np.stack((self.start[tile], self.stop[tile]), axis=-1).reshape(-1)
+    
+    def core_box(self, tile):
+        """
+        Returns the slices of the core box of a tile in the volume.
+        """
+        return tuple(slice(int(lo), int(hi)) for lo, hi in zip(self.start[tile], self.stop[tile]))
+    
+    def halo_box(self, tile):
+        """
+        Returns the start and stop of the halo padded box of a tile in the volume.
+        """
+        return self.start[tile] - self.left[tile], self.stop[tile] + self.right[tile]
+    
+    def halo_shape(self, tile):
+        """
+        Returns the shape of the halo padded box of a tile.
+        """
+        return tuple(int(dim) for dim in self.stop[tile] + self.right[tile] - self.start[tile] + self.left[tile])
+    
+    def core_in_halo(self, tile):
+        """
+        Returns the slices of the core box of a tile in its halo padded box.
+        """
+        core_shape = self.stop[tile] - self.start[tile]
+        return tuple(slice(int(lo), int(lo + dim)) for lo, dim in zip(self.left[tile], core_shape))
+    
+    def tile_of(self, voxels):
+        """
+        Returns the numbers of the tiles whose core box contains the voxels, an array of (x, y, z)
+        coordinates with the coordinates along the last axis.
+        """
+        voxels = np.asarray(voxels, dtype='int64')
+        if np.any(voxels < 0) or np.any(voxels >= np.array(self.vol_shape)):
+            raise ValueError("Voxel coordinates are outside the volume of shape %s" % (self.vol_shape,))
+        ijk = voxels // np.array(self.tile_shape)
+        return np.ravel_multi_index(tuple(np.moveaxis(ijk, -1, 0)), self.grid_shape)
+    
+    def tile_order(self, order='xyz'):
+        """
+        Returns the tile numbers in the given order.
+        'xyz' - tile number order, z changes fastest.
+        'zyx' - x changes fastest.
+        'snake' - 'xyz' with every other row reversed so that successive tiles are neighbours.
+        """
+        order = order.lower()
+        if order == 'xyz':
+            return np.arange(len(self))
+        if order == 'zyx':
+            return np.lexsort((self.ijk[:, 0], self.ijk[:, 1], self.ijk[:, 2]))
+        if order == 'snake':
+            y_key = np.where(self.ijk[:, 0] % 2 == 1, -self.ijk[:, 1], self.ijk[:, 1])
+            z_key = np.where((self.ijk[:, 0] + self.ijk[:, 1]) % 2 == 1, -self.ijk[:, 2], self.ijk[:, 2])
+            return np.lexsort((z_key, y_key, self.ijk[:, 0]))
+        if order == 'morton':
+            return np.argsort(_morton_keys(self.ijk), kind='stable')
+        if order == 'hilbert':
+            return np.argsort(_hilbert_keys(self.ijk), kind='stable')
+        raise ValueError("Unknown tile order %s, use 'xyz', 'zyx', 'snake', 'morton' or 'hilbert'" % order)
+    
+    def rank_tiles(self, tiles, rank, size, order=None, assignment=None):
+        """
+        Returns the tiles of tiles, tile numbers, that rank of size ranks works on, in the order it works on
+        them. The tiles are put in tile_order(order) and handed out as set by assignment:
+        'cyclic' - every size-th tile, starting at the rank-th tile.
+        'block' - a run of consecutive tiles, so that the tiles of a rank are neighbours in the volume
+        when the order is 'snake', 'morton' or 'hilbert'.
+        The defaults are tile_traversal and tile_assignment in the seg_user_param.py file.
+        """
+        if order is None:
+            order = tile_traversal
+        if assignment is None:
+            assignment = tile_assignment
+        ordered = self.tile_order(order)
+        ordered = ordered[np.isin(ordered, tiles)]
+        assignment = assignment.lower()
+        if assignment == 'cyclic':
+            return ordered[rank::size]
+        if assignment == 'block':
+            return np.array_split(ordered, size)[rank]
+        raise ValueError("Unknown tile assignment %s, use 'cyclic' or 'block'" % assignment)
+    
+    def digest(self):
+        """
+        Returns a hex digest of the volume shape, tile shape and overlap, the same for grids with the same
+        tiles.
+        """
+        geometry = json.dumps([self.vol_shape, self.tile_shape, self.overlap])
+        return hashlib.sha1(geometry.encode('utf-8')).hexdigest()
+    
+    def save(self, filename):
+        """
+        Writes the grid into a HDF5 file. The tile datasets have one row per tile and the layout of the
+        datasets of a sub-volume file.
+        """
+        with h5py.File(filename, 'w') as grid_file:
+            grid_file.create_dataset('orig_indices', data=np.stack((self.start, self.stop), axis=-1).reshape(-1, 6).astype('uint64'))
+            grid_file.create_dataset('left_overlap', data=self.left.astype('uint8'))
+            grid_file.create_dataset('right_overlap', data=self.right.astype('uint8'))
+            grid_file.create_dataset('background', data=self.background.astype('uint8'))
+            grid_file.attrs['vol_shape'] = np.array(self.vol_shape, dtype='uint64')
+            grid_file.attrs['tile_shape'] = np.array(self.tile_shape, dtype='uint64')
+            grid_file.attrs['overlap'] = self.overlap
+    
+    @classmethod
+    def load(cls, filename):
+        """
+        Returns the grid saved in a HDF5 file.
+        """
+        with h5py.File(filename, 'r') as grid_file:
+            grid = cls(grid_file.attrs['vol_shape'], grid_file.attrs['tile_shape'], grid_file.attrs['overlap'])
+            if 'background' in grid_file:
+                grid.background = grid_file['background'][...].astype(bool)
+        return grid
+
+
+def _curve_bits(ijk):
+    """
+    Returns the number of bits of the largest grid coordinate.
+    """
+    return max(int(ijk.max()).bit_length(), 1) if len(ijk) else 1
+
+
+def _interleave_bits(coords, bits):
+    """
+    Returns the keys made of the bits of the coordinates (one row per tile) interleaved, the most
+    significant bit of the first coordinate first.
+    """
+    keys = np.zeros((coords.shape[0],), dtype='int64')
+    for bit in range(bits - 1, -1, -1):
+        for axis in range(coords.shape[1]):
+            keys = (keys << 1) | ((coords[:, axis] >> bit) & 1)
+    return keys
+
+
+def _morton_keys(ijk):
+    """
+    Returns the position of each tile along the Morton (Z-order) curve through the grid.
+    """
+    return _interleave_bits(ijk, _curve_bits(ijk))
+
+
+def _hilbert_keys(ijk):
+    """
+    Returns the position of each tile along the Hilbert curve through the cube of power of two side that
+    holds the grid, using Skilling's transform of the coordinates ("Programming the Hilbert curve", 2004).
+    Successive tiles of a cube grid are neighbours; on other grids the curve leaves the grid and comes back
+    at a nearby tile.
+    """
+    bits = _curve_bits(ijk)
+    coords = ijk.astype('int64').copy()
+    # Undo the rotations and reflections of the curve.
+    high = 1 << (bits - 1)
+    while high > 1:
+        low = high - 1
+        for axis in range(3):
+            set_bit = (coords[:, axis] & high) != 0
+            swap = (coords[:, 0] ^ coords[:, axis]) & low
+            if axis == 0:
+                coords[:, 0] = np.where(set_bit, coords[:, 0] ^ low, coords[:, 0])
+            else:
+                first = np.where(set_bit, coords[:, 0] ^ low, coords[:, 0] ^ swap)
+                coords[:, axis] = np.where(set_bit, coords[:, axis], coords[:, axis] ^ swap)
+                coords[:, 0] = first
+        high >>= 1
+    # Gray encode.
+    for axis in range(1, 3):
+        coords[:, axis] ^= coords[:, axis - 1]
+    flip = np.zeros((coords.shape[0],), dtype='int64')
+    high = 1 << (bits - 1)
+    while high > 1:
+        flip = np.where(coords[:, 2] & high, flip ^ (high - 1), flip)
+        high >>= 1
+    coords ^= flip[:, np.newaxis]
+    return _interleave_bits(coords, bits)
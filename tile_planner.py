@@ -0,0 +1,226 @@
+#!/usr/bin/env python 
+
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+Picks the sub-volume (tile) dimensions from the memory available to an Ilastik classifier process.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import h5py
+import numpy as np
+from executor import MPI
+from segmentation_param import *
+
+__author__ = "Mehdi Tondravi"
+__copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['feature_channels',
+           'feature_window_sigmas',
+           'read_feature_selection',
+           'ilp_feature_channels',
+           'feature_reach',
+           'classifier_halo',
+           'bytes_per_voxel',
+           'rank_memory_mb',
+           'tile_memory_mb',
+           'plan_tile_shape']
+
+# Channels of the Ilastik pixel features of a 3D image.
+feature_channels = {'GaussianSmoothing': 1,
+                    'LaplacianOfGaussian': 1,
+                    'GaussianGradientMagnitude': 1,
+                    'DifferenceOfGaussians': 1,
+                    'StructureTensorEigenvalues': 3,
+                    'HessianOfGaussianEigenvalues': 3}
+# Number of Ilastik scales, used when the feature selection can not be read from the project file.
+_default_scale_count = 7
+# Derivative order of the features computed from derivatives, they reach as many voxels further than
+# their Gaussian window.
+_derivative_orders = {'LaplacianOfGaussian': 2,
+                      'GaussianGradientMagnitude': 1,
+                      'StructureTensorEigenvalues': 1,
+                      'HessianOfGaussianEigenvalues': 2}
+# Ilastik computes its features with Gaussian windows of a radius of 3.5 sigma.
+feature_window_sigmas = 3.5
+
+
+def read_feature_selection(ilp_file):
+    """
+    Returns the feature ids, scales and selection matrix (features x scales) of an Ilastik project, or None
+    if the project has no feature selection.
+    """
+    with h5py.File(ilp_file, 'r') as ilp:
+        if 'FeatureSelections/SelectionMatrix' not in ilp or 'FeatureSelections/FeatureIds' not in ilp:
+            return None
+        selection = ilp['FeatureSelections/SelectionMatrix'][...].astype(bool)
+        feature_ids = [feature.decode() if isinstance(feature, bytes) else str(feature)
+                       for feature in ilp['FeatureSelections/FeatureIds'][...]]
+        scales = ilp['FeatureSelections/Scales'][...] if 'FeatureSelections/Scales' in ilp else None
+    return feature_ids, scales, selection
+
+
+def ilp_feature_channels(ilp_file):
+    """
+    Returns the number of feature channels the classifier of an Ilastik project computes for a 3D image,
+    from the feature selection matrix of the project. If the project has no feature selection every
+    feature at every scale is assumed.
+    """
+    feature_selection = read_feature_selection(ilp_file)
+    if feature_selection is None:
+        print("*** No feature selection in %s, assuming all features at all scales ***" % ilp_file)
+        return sum(feature_channels.values()) * _default_scale_count
+    feature_ids, scales, selection = feature_selection
+    channels = 0
+    for feature_id, selected in zip(feature_ids, selection):
+        # Unknown features are counted with the most channels a feature has.
+        channels += feature_channels.get(feature_id, max(feature_channels.values())) * int(selected.sum())
+    return channels
+
+
+def feature_reach(ilp_file=ilp_file_name):
+    """
+    Returns the reach of the widest feature selected in an Ilastik project, the voxels on each side of a
+    voxel its features are computed from: feature_window_sigmas times its largest Gaussian scale, plus the
+    half scale outer smoothing of the structure tensor, plus the derivative order. Returns None if the
+    project has no feature scales.
+    """
+    feature_selection = read_feature_selection(ilp_file)
+    if feature_selection is None or feature_selection[1] is None:
+        return None
+    feature_ids, scales, selection = feature_selection
+    reach = 0
+    for feature_id, selected in zip(feature_ids, selection):
+        for scale in np.asarray(scales, dtype='float64')[selected[:len(scales)]]:
+            if feature_id == 'StructureTensorEigenvalues':
+                scale = 1.5 * scale
+            reach = max(reach, int(np.ceil(feature_window_sigmas * scale)) + _derivative_orders.get(feature_id, 0))
+    return reach
+
+
+def classifier_halo(ilp_file=ilp_file_name):
+    """
+    Returns the sub-volume overlap so that the features of every voxel of a sub-volume are computed from
+    voxels inside its overlap, the reach of the widest selected feature, see feature_reach().
+    pixel_overlap overrides it, pixeloverlap is used if the project has no feature scales.
+    """
+    if pixel_overlap != '':
+        return int(pixel_overlap)
+    halo = feature_reach(ilp_file)
+    if halo is None:
+        print("*** No feature scales in %s, overlap is %d ***" % (ilp_file, pixeloverlap))
+        return pixeloverlap
+    return halo
+
+
+def bytes_per_voxel(ilp_file=ilp_file_name):
+    """
+    Returns the memory used per voxel of a tile by the classification and segmentation of the tile. The
+    feature channels and label probabilities are float32, plus the float32 copy of the image and the label
+    masks, times tile_memory_factor for Ilastik's working memory.
+    """
+    labels = len(get_ilastik_labels())
+    return (ilp_feature_channels(ilp_file) + labels + 2) * 4 * float(tile_memory_factor)
+
+
+def rank_memory_mb(comm):
+    """
+    Returns the megabytes of memory for the classifier of one rank, percent_mem_to_use of the memory of a
+    server divided among the ranks running on it. The ranks per server are ranks_per_node or, if it is
+    blank, the ranks of comm running on this server.
+    """
+    if not percent_mem_to_use:
+        # Use all available memory
+        ram = int(ram_size)
+    else:
+        ram = int(ram_size * (int(percent_mem_to_use)/100.0))
+    if ranks_per_node:
+        node_ranks = int(ranks_per_node)
+    else:
+        node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.Get_rank())
+        node_ranks = node_comm.Get_size()
+        node_comm.Free()
+    return int(ram / max(node_ranks, 1))
+
+
+def tile_memory_mb(halo_shape, voxel_bytes):
+    """
+    Returns the megabytes needed to classify a tile whose halo padded box has the given shape.
+    """
+    return int(np.prod(np.array(halo_shape, dtype='float64')) * voxel_bytes / 1e6)
+
+
+def plan_tile_shape(vol_shape, memory_mb, voxel_bytes, overlap=None):
+    """
+    Returns the largest tile shape whose halo padded box fits in memory_mb, or None if not even a one voxel
+    tile fits. Large tiles have the least halo voxels classified twice. The padded box is kept close to a
+    cube, an axis that fits whole into a tile is not divided and has no halo. The tile shape is then evened
+    out so that the tiles along an axis have about the same size.
+    """
+    if overlap is None:
+        overlap = pixeloverlap
+    max_voxels = memory_mb * 1e6 / voxel_bytes
+    tile_shape = [None, None, None]
+    while True:
+        free_axes = [axis for axis in range(3) if tile_shape[axis] is None]
+        fixed_voxels = np.prod([float(tile_shape[axis]) for axis in range(3) if tile_shape[axis] is not None])
+        side = (max_voxels / fixed_voxels) ** (1.0 / len(free_axes)) - 2 * overlap
+        whole_axes = [axis for axis in free_axes if vol_shape[axis] <= side]
+        if not whole_axes:
+            break
+        for axis in whole_axes:
+            tile_shape[axis] = int(vol_shape[axis])
+        if len(whole_axes) == len(free_axes):
+            break
+    for axis in range(3):
+        if tile_shape[axis] is None:
+            if side < 1:
+                return None
+            tile_shape[axis] = int(side)
+    tile_count = [int(np.ceil(vol_dim / tile_dim)) for vol_dim, tile_dim in zip(vol_shape, tile_shape)]
+    return tuple(int(np.ceil(vol_dim / count)) for vol_dim, count in zip(vol_shape, tile_count))
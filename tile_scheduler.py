@@ -0,0 +1,177 @@
+#!/usr/bin/env python 
+
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+Divides the tiles (sub-volumes) of the grid among the ranks for classification, statically or through a
+shared work queue from which ranks take the next tile when they finish one.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from glob import glob
+import time
+import h5py
+import numpy as np
+from executor import MPI
+from segmentation_param import *
+
+__author__ = "Mehdi Tondravi"
+__copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['TileScheduler',
+           'tile_costs']
+
+
+class TileScheduler(object):
+    """
+    Iterates over the tiles of a rank as set by tile_scheduling in the seg_user_param.py file.
+    'static' - the tiles given to the rank by grid.rank_tiles().
+    'dynamic' - the tiles are a queue shared by the ranks, a rank takes the next tile of the queue when it is
+    done with its tile. The queue position is a counter in an MPI window of rank 0 that is read and
+    incremented with one atomic fetch and add, so no rank is set aside to hand out tiles. The queue is in
+    tile_traversal order or, if tile_cost_order is 'yes', in decreasing estimated cost, see tile_costs().
+    
+    The time a rank spends on its tiles is measured between the tiles it is given. close() must be called
+    by every rank, it prints the tiles and busy time of each rank.
+    """
+    
+    def __init__(self, grid, tiles, comm):
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+        self.dynamic = tile_scheduling.lower() == 'dynamic'
+        self.tile_count = 0
+        self.busy_time = 0.0
+        self.start_time = time.time()
+        self._window = None
+        if not self.dynamic:
+            self.queue = grid.rank_tiles(tiles, self.rank, self.size)
+            return
+        if tile_cost_order.lower() == 'yes':
+            costs = None
+            if self.rank == 0:
+                costs = tile_costs(grid, tiles)
+            costs = comm.bcast(costs, root=0)
+            self.queue = np.asarray(tiles)[np.argsort(-costs, kind='stable')]
+        else:
+            self.queue = grid.rank_tiles(tiles, 0, 1)
+        if self.size > 1:
+            self._next = np.zeros((1,), dtype='int64')
+            self._one = np.ones((1,), dtype='int64')
+            # The counter is only in the window of rank 0.
+            self._counter = np.zeros((1 if self.rank == 0 else 0,), dtype='int64')
+            self._window = MPI.Win.Create(self._counter, self._counter.itemsize, comm=comm)
+    
+    def __iter__(self):
+        for tile in self._take_tiles():
+            tile_start = time.time()
+            yield tile
+            self.busy_time += time.time() - tile_start
+            self.tile_count += 1
+    
+    def _take_tiles(self):
+        """
+        Yields the tiles of the queue, taken from the shared queue until it is empty when there is a window.
+        """
+        if self._window is None:
+            for tile in self.queue:
+                yield tile
+            return
+        while True:
+            self._window.Lock(0, MPI.LOCK_SHARED)
+            self._window.Fetch_and_op(self._one, self._next, 0, 0, MPI.SUM)
+            self._window.Unlock(0)
+            if self._next[0] >= len(self.queue):
+                return
+            yield self.queue[self._next[0]]
+    
+    def close(self):
+        """
+        Waits for all ranks, frees the queue and prints the utilization of the ranks: a rank is busy while
+        it works on a tile and idle while it waits for the other ranks to finish.
+        """
+        wall_time = time.time() - self.start_time
+        stats = self.comm.gather((self.tile_count, self.busy_time, wall_time), root=0)
+        if self._window is not None:
+            self._window.Free()
+            self._window = None
+        if self.rank != 0:
+            return
+        tile_counts, busy_times, wall_times = (np.array(column, dtype='float64') for column in zip(*stats))
+        span = max(wall_times.max(), 1e-9)
+        for rank_idx in range(self.size):
+            print("rank is %d, tiles %d, busy time is %.1f Sec, utilization is %.0f%%" %
+                  (rank_idx, tile_counts[rank_idx], busy_times[rank_idx], 100.0 * busy_times[rank_idx] / span))
+        print("*** %s scheduling: busy time per rank min %.1f, mean %.1f, max %.1f Sec, utilization is %.0f%% ***" %
+              (tile_scheduling, busy_times.min(), busy_times.mean(), busy_times.max(),
+               100.0 * busy_times.sum() / (self.size * span)))
+
+
+def tile_costs(grid, tiles):
+    """
+    Returns the estimated classification cost of the tiles, the voxels of their halo padded box. When the
+    volume file has a pyramid, see tiff_to_hdf5_mpi.py, the voxels are weighted by one plus the fraction of
+    the tile's blocks of the coarsest level above background_threshold: features are computed for every
+    voxel, the classifier and the segmentation of foreground voxels cost more.
+    """
+    tiles = np.asarray(tiles)
+    halo_shapes = (grid.stop + grid.right - grid.start + grid.left)[tiles]
+    costs = np.prod(halo_shapes.astype('float64'), axis=1)
+    hdf5_vol_file = sorted(glob(hdf_files_location + '/*.hdf5'))
+    if volume_backend.lower() == 'tiff' or not hdf5_vol_file:
+        return costs
+    with h5py.File(hdf5_vol_file[0], 'r') as vol_file:
+        if 'pyramid' not in vol_file:
+            return costs
+        factor = max(vol_file['pyramid'][level].attrs['downsample_factor'] for level in vol_file['pyramid'])
+        level_data = vol_file['pyramid/%dx' % factor][...]
+    for idx, tile in enumerate(tiles):
+        halo_start, halo_stop = grid.halo_box(tile)
+        level_box = tuple(slice(int(lo) // factor, -(-int(hi) // factor)) for lo, hi in zip(halo_start, halo_stop))
+        costs[idx] *= 1.0 + np.mean(level_data[level_box] > background_threshold)
+    return costs
@@ -0,0 +1,254 @@
+#!/usr/bin/env python 
+
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+Volume image backends - the volume is read from the HDF5 file created by tiff_to_hdf5_mpi.py or
+directly from the TIFF files without an HDF5 copy.
+'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os.path
+from collections import OrderedDict
+from glob import glob
+import h5py
+import numpy as np
+import tifffile
+from segmentation_param import *
+from executor import SerialComm
+from tiff_stack import list_tiff_slices, tiff_slice_info, read_tiff_slice
+
+__author__ = "Mehdi Tondravi"
+__copyright__ = "Copyright (c) 2017, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['TiffStackVolume',
+           'create_external_volume',
+           'open_volume',
+           'process_volume',
+           'read_volume_box']
+
+# The volume opened by process_volume(), the open file and the volume.
+_process_volume = None
+
+
+class TiffStackVolume(object):
+    """
+    Presents the slices of a TIFF stack, see list_tiff_slices(), as a read-only 3D array that is read
+    lazily on slicing.
+    
+    Uncompressed slices are read through a memory map so that only the selected rows are read from disk.
+    Compressed slices are decoded whole, the most recently decoded slices are kept in a cache of
+    cache_mb megabytes.
+    """
+    
+    def __init__(self, slices, cache_mb=tiff_cache_mb):
+        self.slices = slices
+        data_shape, data_type = tiff_slice_info(slices[0])
+        self.shape = (len(slices),) + data_shape
+        self.dtype = data_type
+        # Each slice is stored on its own, reading whole slices avoids reading rows one at a time.
+        self.chunks = (1,) + self.shape[1:]
+        self._cache = OrderedDict()
+        self._cache_slices = int(cache_mb * 1e6 / max(int(np.prod(self.shape[1:])) * self.dtype.itemsize, 1))
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            ellipsis_idx = key.index(Ellipsis)
+            key = key[:ellipsis_idx] + (slice(None),) * (4 - len(key)) + key[ellipsis_idx + 1:]
+        key = key + (slice(None),) * (3 - len(key))
+        slice_indices = np.arange(self.shape[0])[key[0]]
+        if np.ndim(slice_indices) == 0:
+            return self._read_slice(int(slice_indices))[key[1:]]
+        out = None
+        for out_idx, slice_idx in enumerate(slice_indices):
+            data = self._read_slice(int(slice_idx))[key[1:]]
+            if out is None:
+                out = np.empty((len(slice_indices),) + data.shape, dtype=self.dtype)
+            out[out_idx] = data
+        if out is None:
+            out = np.empty((0,) + np.empty(self.shape[1:], dtype=np.bool_)[key[1:]].shape, dtype=self.dtype)
+        return out
+    
+    def _read_slice(self, slice_idx):
+        """
+        Returns a memory map of an uncompressed slice or the decoded image of a compressed slice.
+        """
+        if slice_idx in self._cache:
+            image = self._cache.pop(slice_idx)
+            self._cache[slice_idx] = image
+            return image
+        image = read_tiff_slice(self.slices[slice_idx], memmap=True)
+        if isinstance(image, np.memmap):
+            return image
+        if self._cache_slices > 0:
+            self._cache[slice_idx] = image
+            while len(self._cache) > self._cache_slices:
+                self._cache.popitem(last=False)
+        return image
+
+
+def create_external_volume(slices, hdf_file_name, data_set_name):
+    """
+    Creates a HDF5 file with a volume dataset whose storage is the image data of the TIFF slices, so the
+    volume is not copied. Requires uncompressed TIFF files with contiguous image data.
+    
+    Returns True if the file was created and False if the TIFF files can not be used as external storage.
+    """
+    external = []
+    data_shape, data_type = tiff_slice_info(slices[0])
+    tiff = None
+    for filename, page in slices:
+        if tiff is None or tiff.filehandle.path != os.path.abspath(filename):
+            if tiff is not None:
+                tiff.close()
+            tiff = tifffile.TiffFile(filename)
+        data_range = _contiguous_data(tiff, page)
+        page_type = np.dtype(tiff.series[0].dtype).newbyteorder(tiff.byteorder)
+        if data_range is None:
+            print("*** TIFF file %s is compressed or not contiguous, it can not be used as external storage ***" % filename)
+            tiff.close()
+            return False
+        if tuple(tiff.series[0].shape[-2:]) != data_shape or page_type.newbyteorder('=') != data_type.newbyteorder('='):
+            print("*** TIFF file %s does not match the shape or type of the first TIFF file ***" % filename)
+            tiff.close()
+            return False
+        if len(external) == 0:
+            data_type = page_type
+        elif page_type != data_type:
+            print("*** TIFF file %s does not have the byte order of the first TIFF file ***" % filename)
+            tiff.close()
+            return False
+        external.append((os.path.abspath(filename), data_range[0], data_range[1]))
+    tiff.close()
+    with h5py.File(hdf_file_name, 'w') as hdf_file:
+        hdf_file.create_dataset(data_set_name, (len(slices),) + data_shape, data_type, external=external)
+        hdf_file.attrs['volume_backend'] = 'external'
+    return True
+
+
+def _contiguous_data(tiff, page):
+    """
+    Returns (offset, bytecount) of the uncompressed, contiguous image data of a page of an open TIFF file
+    or None.
+    """
+    series = tiff.series[0]
+    page_bytes = int(np.prod(series.shape[-2:])) * np.dtype(series.dtype).itemsize
+    if series.dataoffset is not None:
+        # All pages of the series are stored one after another.
+        return series.dataoffset + page * page_bytes, page_bytes
+    tiff_page = tiff.pages[page]
+    if tiff_page.compression != 1 or len(tiff_page.shape) != 2:
+        return None
+    contiguous = tiff_page.is_contiguous
+    if not contiguous:
+        return None
+    if isinstance(contiguous, tuple):
+        # Older tifffile versions return the offset and byte count.
+        return contiguous
+    return tiff_page.dataoffsets[0], page_bytes
+
+
+def open_volume(comm):
+    """
+    Opens the volume image for reading as specified by volume_backend in the seg_user_param.py file.
+    
+    Returns the open HDF5 file, None for the 'tiff' backend, and the volume dataset or TiffStackVolume.
+    Returns (None, None) if the volume is not found.
+    """
+    parent_dir, tiff_dir = os.path.split(tiff_files_location)
+    if volume_backend.lower() == 'tiff':
+        slices = list_tiff_slices(tiff_files_location)
+        if not slices:
+            print("*** Did not find any TIFF file in %s ***" % tiff_files_location)
+            return None, None
+        return None, TiffStackVolume(slices)
+    # assumes volume image file extension is .hdf5
+    hdf5_vol_file = sorted(glob(hdf_files_location + '/*.hdf5'))
+    if not hdf5_vol_file:
+        print("*** Did not find volume file ending with .hdf5 extension  ***")
+        return None, None
+    # Need Parallel HDF for faster processing. However the below test lets processing to continue even if
+    # Parallel HDF is not available. External storage is not supported by Parallel HDF, the read-only
+    # file is opened by each rank.
+    if comm.Get_size() == 1 or volume_backend.lower() == 'external':
+        vol_file = h5py.File(hdf5_vol_file[0], 'r')
+    else:
+        vol_file = h5py.File(hdf5_vol_file[0], 'r', driver='mpio', comm=comm)
+    return vol_file, vol_file[tiff_dir]
+
+
+def process_volume():
+    """
+    Returns the volume opened for reading by this process alone, see open_volume(). The volume is opened
+    by the first call, for the worker processes of the local executor that can not share the open volume of
+    the driver process.
+    """
+    global _process_volume
+    if _process_volume is None:
+        _process_volume = open_volume(SerialComm())
+    return _process_volume[1]
+
+
+def read_volume_box(vol_dataset, start, stop):
+    """
+    Reads the box start:stop (x, y, z) of the volume. A chunked volume, chunks are aligned to the
+    sub-volume grid, is read in one call so that each chunk is read and decompressed once, otherwise the
+    box is read one slice at a time.
+    """
+    box = tuple(slice(int(lo), int(hi)) for lo, hi in zip(start, stop))
+    if vol_dataset.chunks is not None:
+        return vol_dataset[box]
+    data = np.empty(tuple(int(hi) - int(lo) for lo, hi in zip(start, stop)), dtype=vol_dataset.dtype)
+    for row in range(data.shape[0]):
+        data[row, :, :] = vol_dataset[box[0].start + row, box[1], box[2]]
+    return data